@@ -0,0 +1,163 @@
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""In-process writer and verifier of the diskdatatest pattern"""
+import os
+import io
+import mmap
+import struct
+from array import array
+from XenCertLog import XenCertPrint
+
+# The layout of diskdatatest: each 512 byte sector is split into 32 slices
+# of two 64-bit little endian words, the sector number and an iterator, which
+# goes up by one from slice to slice over the entire device. So sector S holds
+# the iterators iterStart + S*32 to iterStart + S*32 + 31, whatever the block
+# size diskdatatest wrote it with.
+SECTOR_SIZE = 512
+SLICES_OF_SECTOR = SECTOR_SIZE / 16
+CHUNK_SECTORS = 2048            # sectors written or read at once: 1 MiB
+MAX_ERROR_LOGS = 5              # bad sectors logged in detail by a verify
+
+# array of the 64-bit words, 'L' is 64-bit on the 64-bit dom0
+WORD_TYPE = 'L'
+
+# byte 0 and byte 1 of 0 to 0xffff, the low 16 bits of the words
+_LOW_BYTES = [''.join([chr((i >> shift) & 0xff) for i in range(0x10000)]) for shift in (0, 8)]
+
+def _Sequence(start, count):
+    # The words start, start + 1, ..., start + count - 1 as an array. It is
+    # built by byte planes, which are slices of the strings above for the low
+    # 16 bits, and constant between two carries into the high bits.
+    words = bytearray(count * 8)
+    done = 0
+    while done < count:
+        value = start + done
+        low = value & 0xffff
+        n = min(count - done, 0x10000 - low)
+        high = struct.pack('<Q', value)
+        for b in range(8):
+            if b < 2:
+                plane = _LOW_BYTES[b][low:low + n]
+            else:
+                plane = high[b] * n
+            words[8*done + b:8*(done + n):8] = plane
+        done += n
+    return array(WORD_TYPE, str(words))
+
+def BuildPattern(startSect, sects, iterStart):
+    # The pattern of the sectors [startSect, startSect + sects) as a string
+    words = array(WORD_TYPE, [0]) * (sects * SLICES_OF_SECTOR * 2)
+    sectors = _Sequence(startSect, sects)
+    for j in range(SLICES_OF_SECTOR):
+        words[2*j::SLICES_OF_SECTOR*2] = sectors
+    words[1::2] = _Sequence(iterStart + startSect * SLICES_OF_SECTOR, sects * SLICES_OF_SECTOR)
+    return words.tostring()
+
+def _Open(device, write, direct):
+    flags = os.O_RDWR if write else os.O_RDONLY
+    if direct:
+        flags |= os.O_DIRECT
+    return os.open(device, flags)
+
+def _Chunks(startSect, endSect):
+    # The chunks of the sectors [startSect, endSect), as (first sector, sectors)
+    sect = startSect
+    while sect < endSect:
+        sects = min(CHUNK_SECTORS, endSect - sect)
+        yield (sect, sects)
+        sect += sects
+
+class _AlignedBuffers:
+    # Page aligned buffers, as O_DIRECT needs, one of each size in use
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, size):
+        if not self.buffers.has_key(size):
+            self.buffers[size] = mmap.mmap(-1, size)
+        return self.buffers[size]
+
+    def close(self):
+        for buf in self.buffers.values():
+            buf.close()
+        self.buffers = {}
+
+def WritePattern(device, startSect, endSect, iterStart, direct=True):
+    # Write the pattern of iterStart onto the sectors [startSect, endSect) of
+    # the device, a chunk at a time through a preallocated aligned buffer
+    fd = _Open(device, True, direct)
+    buffers = _AlignedBuffers()
+    try:
+        os.lseek(fd, startSect * SECTOR_SIZE, os.SEEK_SET)
+        for (sect, sects) in _Chunks(startSect, endSect):
+            buf = buffers.get(sects * SECTOR_SIZE)
+            buf.seek(0)
+            buf.write(BuildPattern(sect, sects, iterStart))
+            written = os.write(fd, buf)
+            if written != len(buf):
+                raise Exception("Short write of %d bytes at sector %d of %s" % (written, sect, device))
+        if not direct:
+            os.fsync(fd)
+    finally:
+        buffers.close()
+        os.close(fd)
+    XenCertPrint("Wrote the pattern of iter %d onto sectors %d to %d of %s" % (iterStart, startSect, endSect, device))
+
+def _SectorErrors(actual, expect, sect, errors):
+    # Count the sectors of a chunk which do not match the pattern, logging
+    # the first few of the verify
+    bad = 0
+    for offset in range(0, len(expect), SECTOR_SIZE):
+        if actual[offset:offset + SECTOR_SIZE] == expect[offset:offset + SECTOR_SIZE]:
+            continue
+        if errors + bad < MAX_ERROR_LOGS:
+            # log the first slice which does not match
+            first = offset
+            while actual[first:first + 16] == expect[first:first + 16]:
+                first += 16
+            XenCertPrint("Unmatched sector %d: sector %d, iter %d instead of sector %d, iter %d" % \
+                         ((sect + offset / SECTOR_SIZE,) + struct.unpack_from('<QQ', actual, first) + \
+                          struct.unpack_from('<QQ', expect, first)))
+        bad += 1
+    return bad
+
+def VerifyPattern(device, startSect, endSect, iterStart, direct=True):
+    # Read back the sectors [startSect, endSect) of the device, and return
+    # the number of them which do not hold the pattern of iterStart. Each
+    # chunk is read with readinto a preallocated aligned buffer, and only
+    # compared sector by sector when it does not match as a whole.
+    fd = _Open(device, False, direct)
+    f = io.FileIO(fd, 'r', closefd=False)
+    buffers = _AlignedBuffers()
+    errors = 0
+    try:
+        os.lseek(fd, startSect * SECTOR_SIZE, os.SEEK_SET)
+        for (sect, sects) in _Chunks(startSect, endSect):
+            buf = buffers.get(sects * SECTOR_SIZE)
+            read = f.readinto(buf)
+            if read != len(buf):
+                raise Exception("Short read of %d bytes at sector %d of %s" % (read, sect, device))
+            expect = BuildPattern(sect, sects, iterStart)
+            actual = buf[:]
+            if actual != expect:
+                errors += _SectorErrors(actual, expect, sect, errors)
+    finally:
+        buffers.close()
+        f.close()
+        os.close(fd)
+    XenCertPrint("Verified the pattern of iter %d on sectors %d to %d of %s: %d sector errors" % \
+                 (iterStart, startSect, endSect, device, errors))
+    return errors
@@ -15,9 +15,13 @@
 
 """Storage handler classes for various storage drivers"""
 import copy
+import functools
+import threading
 from threading import Thread
 import time
 import os
+import mmap
+from array import array
 import commands
 import glob
 import random
@@ -37,13 +41,6 @@ from srmetadata import LVMMetadataHandler, updateLengthInHeader, open_file, clos
 import metadata
 
 
-retValIO = 0
-timeTaken = '' 
-bytesCopied = ''
-speedOfCopy = ''
-pathsFailed = False
-failoverTime = 0
-
 RPCINFO_BIN = "/usr/sbin/rpcinfo"
 
 # simple tracer
@@ -54,66 +51,151 @@ def report(predicate, condition):
 # Hardcoded time limit for Functional tests in hours
 timeLimitFunctional = 4
 
-class TimedDeviceIO(Thread):
-    def __init__(self, device):
+# VDIs filled and deleted by the space reclamation test, and their size in GiB
+reclaimVDIs = 2
+reclaimVDISize = 1
+
+# Size of the writes of the IO prober of the multipath tests, and the seconds
+# it writes for before the failovers to find the initial write time
+probeBlockSize = 1024 * 1024
+probeBaselineTime = 5
+
+# Seconds the paths of the multipath tests have to fail over and to be restored in
+failoverTimeout = 50
+restoreTimeout = 120
+
+class DeviceIOProber(Thread):
+    # Write a block to the start of the device with O_DIRECT, back to back
+    # until stopped, recording the monotonic time each write started at and
+    # its latency, so that the longest IO stall during a failover is known.
+    # The writes collected are passed on to the timeline, if any.
+    def __init__(self, device, blockSize=probeBlockSize, timeline=None):
         Thread.__init__(self)
-        self.device = device
+        self.device = '/dev/' + device
+        self.blockSize = blockSize
+        self.timeline = timeline
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.starts = array('d')
+        self.latencies = array('d')
+        self.inflight = None
+        self.error = None
 
     def run(self):
-        # Sleep for a period of time before checking for any incomplete snapshots to clean.
-        devicename = '/dev/' + self.device
-        ddOutFile = 'of=' + devicename
-        XenCertPrint("Now copy data from /dev/zero to this device and record the time taken to copy it." )
-        cmd = ['dd', 'if=/dev/zero', ddOutFile, 'bs=1M', 'count=1', 'oflag=direct']
         try:
-            global retValIO
-            global bytesCopied
-            global timeTaken
-            global speedOfCopy
-            retValIO = 0
-            timeTaken = '' 
-            bytesCopied = ''
-            speedOfCopy = ''
-
-            (retValIO, stdout, stderr) = util.doexec(cmd,'')
-            if retValIO != 0:
-                raise Exception("Disk IO failed for device: %s." % self.device)
-            list = stderr.split('\n')
-            
-            bytesCopied = list[2].split(',')[0]
-            timeTaken = list[2].split(',')[1]
-            speedOfCopy = list[2].split(',')[2]
-
-            XenCertPrint("The IO test returned rc: %s stdout: %s, stderr: %s" % (retValIO, stdout, list))
+            fd = os.open(self.device, os.O_WRONLY | os.O_DIRECT)
+            # an anonymous mmap is page aligned, as O_DIRECT needs
+            buf = mmap.mmap(-1, self.blockSize)
+            try:
+                while not self.stopping.isSet():
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    self.inflight = StorageHandlerUtil.MonotonicTime()
+                    written = os.write(fd, buf)
+                    end = StorageHandlerUtil.MonotonicTime()
+                    if written != self.blockSize:
+                        raise Exception("Short write of %d bytes to %s" % (written, self.device))
+                    self.lock.acquire()
+                    self.starts.append(self.inflight)
+                    self.latencies.append(end - self.inflight)
+                    self.inflight = None
+                    self.lock.release()
+            finally:
+                buf.close()
+                os.close(fd)
         except Exception, e:
-                XenCertPrint("Could not write through the allocated disk space on test disk, please check the storage configuration manually. Exception: %s" % str(e))
-
-class WaitForFailover(Thread):
-    def __init__(self, session, scsiid, activePaths, noOfPaths, checkFunc):
-        Thread.__init__(self)        
+            XenCertPrint("Disk IO failed for device: %s. Exception: %s" % (self.device, str(e)))
+            self.error = e
+
+    def Stop(self):
+        self.stopping.set()
+        self.join()
+
+    def Collect(self):
+        # Return the (count, max latency, time of its start) of the writes
+        # since the last call, and forget them. A write still in flight counts
+        # with the time it has taken so far, so that a hung IO is not missed.
+        self.lock.acquire()
+        (starts, latencies) = (self.starts, self.latencies)
+        (self.starts, self.latencies) = (array('d'), array('d'))
+        inflight = self.inflight
+        self.lock.release()
+        if self.timeline is not None:
+            self.timeline.AddIOs(starts, latencies)
+
+        (maxLatency, maxStart) = (0, None)
+        if latencies:
+            maxLatency = max(latencies)
+            maxStart = starts[latencies.index(maxLatency)]
+        if inflight is not None and StorageHandlerUtil.MonotonicTime() - inflight > maxLatency:
+            (maxLatency, maxStart) = (StorageHandlerUtil.MonotonicTime() - inflight, inflight)
+        XenCertPrint("IO prober on %s: %d writes, the longest took %f seconds" % (self.device, len(latencies), maxLatency))
+        return (len(latencies), maxLatency, maxStart)
+
+    def Check(self):
+        if self.error is not None:
+            raise Exception("    - IO test failed for device %s. Exception: %s" % (self.device, str(self.error)))
+
+class MultipathLUN:
+    # A LUN of the multipath tests: its SR, the watcher of its paths, the
+    # timeline of its IO stalls, and the VDI and VBD its IO prober writes to
+    def __init__(self, session, scsiid, sr_ref):
+        self.session = session
         self.scsiid = scsiid
-        self.activePaths = activePaths
-        self.noOfPaths = noOfPaths
-        self.checkFunc = checkFunc
+        self.sr_ref = sr_ref
+        self.totalPaths = 0
+        self.fullPaths = 0
+        self.timeline = None
+        self.watcher = None
+        self.vdi_ref = None
+        self.vbd_ref = None
+        self.prober = None
+
+    def Watch(self):
+        # Count the paths, the active ones being those to restore after a
+        # failover, and start watching them
+        (retVal, listPathConfig) = StorageHandlerUtil.get_path_status(self.scsiid)
+        if not retVal:
+            raise Exception("Failed to get path status information for SCSI Id: %s" % self.scsiid)
+        self.totalPaths = len(listPathConfig)
+        self.fullPaths = len([item for item in listPathConfig if item[1] == 'active'])
+        self.timeline = StorageHandlerUtil.IOStallTimeline(self.scsiid)
+        self.watcher = StorageHandlerUtil.PathWatcher(self.scsiid, self.timeline)
+        self.watcher.start()
+
+    def Attach(self):
+        (retVal, self.vdi_ref, self.vbd_ref, vdi_size) = StorageHandlerUtil.CreateMaxSizeVDIAndVBD(self.session, self.sr_ref)
+        if not retVal:
+            raise Exception("Failed to create max size VDI and VBD on %s." % self.scsiid)
+
+    def StartProber(self):
+        self.prober = DeviceIOProber(self.session.xenapi.VBD.get_device(self.vbd_ref), timeline=self.timeline)
+        self.prober.start()
+
+    def EndIteration(self):
+        # The writes still to collect are of the iteration too
+        if self.prober is not None:
+            self.prober.Collect()
+        return self.timeline.EndIteration()
+
+    def Cleanup(self):
+        # Keep the events of an iteration which failed, above all
+        if self.prober is not None:
+            self.prober.Stop()
+        if self.watcher is not None:
+            self.watcher.Stop()
+        if self.timeline is not None:
+            self.EndIteration()
+        if self.vbd_ref is not None:
+            self.session.xenapi.VBD.unplug(self.vbd_ref)
+            XenCertPrint("Unplugged VBD %s" % self.vbd_ref)
+            self.session.xenapi.VBD.destroy(self.vbd_ref)
+            XenCertPrint("Destroyed VBD %s" % self.vbd_ref)
+            self.vbd_ref = None
+        if self.vdi_ref is not None:
+            self.session.xenapi.VDI.destroy(self.vdi_ref)
+            XenCertPrint("Destroyed VDI %s" % self.vdi_ref)
+            self.vdi_ref = None
 
-    def run(self):
-        # Here wait for the expected number of paths to fail.        
-        active = 0
-        global pathsFailed
-        global failoverTime
-        pathsFailed = False
-        failoverTime = 0        
-        while not pathsFailed and failoverTime < 50:
-            try:
-                (retVal, listPathConfigNew) = StorageHandlerUtil.get_path_status(self.scsiid, True)
-                currNoOfPaths = (int)(self.activePaths) - len(listPathConfigNew)
-                if self.checkFunc(currNoOfPaths, self.noOfPaths):
-                    pathsFailed = True
-                time.sleep(1)
-                failoverTime += 1                
-            except Exception, e:                
-                raise Exception(e)
-            
 class StorageHandler(object):
     KEYS_NOT_POPULATED_BY_THE_STORAGE = ['allowed_operations',
                                          'current_operations',
@@ -135,6 +217,22 @@ class StorageHandler(object):
         self.storage_conf = storage_conf
         self.session = util.get_localAPI_session()
         self.sm_config = {}
+        # Rate limits of the disk IO tests, 0 for none
+        self.rateMBps = float(storage_conf.get('rateMBps') or 0)
+        self.rateIOPS = float(storage_conf.get('rateIOPS') or 0)
+        # Block sizes in KiB to benchmark before the disk IO tests, none by default
+        self.blockSizes = [int(size) for size in (storage_conf.get('blockSizes') or '').split(',') if size]
+        # Read percentage of the mixed read/write disk IO test, None to skip it
+        self.readPercent = None
+        if storage_conf.get('readPercent'):
+            self.readPercent = int(storage_conf['readPercent'])
+        self.concurrentLUNs = None
+        if storage_conf.get('concurrentLUNs'):
+            self.concurrentLUNs = int(storage_conf['concurrentLUNs'])
+        # Number of LUNs to fail over at once in the multipath tests
+        self.mpLUNs = int(storage_conf.get('mpLUNs') or 1)
+        # Timelines of the IO stalls of the multipath tests, one per LUN
+        self.timelines = []
     
     def performSRTrim(self, sr_ref):
         try:
@@ -145,6 +243,157 @@ class StorageHandler(object):
         except Exception, e:
             XenCertPrint("TRIM tests failed due to exception: %s" %(str(e)))
             return False
+
+    def _SRUtilisation(self, sr_ref):
+        self.session.xenapi.SR.scan(sr_ref)
+        return int(self.session.xenapi.SR.get_physical_utilisation(sr_ref))
+
+    def SpaceReclamationTest(self, sr_ref):
+        # Fill VDIs on the SR with data, delete them and trim the SR, and
+        # report the time the trim took and the space the SR reclaimed, from
+        # its physical utilisation before and after each step. Return the
+        # status of the trim plugin.
+        vm_ref = self.session.xenapi.VM.get_by_uuid(StorageHandlerUtil._get_localhost_uuid())
+        vdi_refs = []
+        vbd_ref = None
+        try:
+            utilBefore = self._SRUtilisation(sr_ref)
+            for i in range(reclaimVDIs):
+                (retVal, vdi_ref) = self.Create_VDI(sr_ref, reclaimVDISize * StorageHandlerUtil.GiB)
+                if not retVal:
+                    raise Exception("VDI creation failed: %s" % vdi_ref)
+                vdi_refs.append(vdi_ref)
+                vbd_ref = StorageHandlerUtil.Attach_VDI(self.session, vdi_ref, vm_ref)
+                StorageHandlerUtil.WriteDataToVDI(self.session, vbd_ref, 0, reclaimVDISize - 1)
+                StorageHandlerUtil.Detach_VDI(self.session, vbd_ref)
+                vbd_ref = None
+            utilFilled = self._SRUtilisation(sr_ref)
+            Print("      Filled %d VDIs of %d GiB, SR utilisation up by %d MiB." % \
+                  (reclaimVDIs, reclaimVDISize, (utilFilled - utilBefore) / StorageHandlerUtil.MiB))
+
+            while vdi_refs:
+                self.Destroy_VDI(vdi_refs.pop())
+            utilDeleted = self._SRUtilisation(sr_ref)
+            Print("      Deleted the VDIs, SR utilisation down by %d MiB." % ((utilFilled - utilDeleted) / StorageHandlerUtil.MiB))
+
+            start = time.time()
+            trim_status = self.performSRTrim(sr_ref)
+            trimTime = time.time() - start
+            utilTrimmed = self._SRUtilisation(sr_ref)
+            Print("      Trimmed the SR in %.3f seconds, SR utilisation down by %d MiB." % \
+                  (trimTime, (utilDeleted - utilTrimmed) / StorageHandlerUtil.MiB))
+            XenCertPrint("SR %s physical utilisation: %d before, %d filled, %d deleted, %d trimmed in %f seconds" % \
+                         (sr_ref, utilBefore, utilFilled, utilDeleted, utilTrimmed, trimTime))
+            return trim_status
+        finally:
+            if vbd_ref is not None:
+                StorageHandlerUtil.Detach_VDI(self.session, vbd_ref)
+            for vdi_ref in vdi_refs:
+                self.Destroy_VDI(vdi_ref)
+
+    def GetDiskIOTestBlockSize(self, devices, size):
+        # Benchmark the block sizes given with -z on the paths to a LUN, and
+        # return the one with the highest throughput, in sectors, for the
+        # disk IO tests of the LUN. Without -z, return the default size.
+        if not self.blockSizes:
+            return StorageHandlerUtil.DDT_DEFAULT_BLOCK_SIZE
+
+        # kib, as Python 2 would rebind size to a comprehension variable of that name
+        Print("        Benchmarking block sizes of %s KiB." % ', '.join([str(kib) for kib in self.blockSizes]))
+        sectors = [kib * 1024 / StorageHandlerUtil.DDT_SECTOR_SIZE for kib in self.blockSizes]
+        (results, best) = StorageHandlerUtil.DiskDataTestSweep(devices, size, sectors, self.rateMBps, self.rateIOPS)
+        StorageHandlerUtil.PrintDiskDataTestSweep(results)
+        if best is None:
+            Print("        All the block sizes failed, testing with the default block size.")
+            return StorageHandlerUtil.DDT_DEFAULT_BLOCK_SIZE
+        Print("        Testing with the block size of the highest throughput: %d KiB." % (best * StorageHandlerUtil.DDT_SECTOR_SIZE / 1024))
+        return best
+
+    def DiskIOTestLUN(self, key, devices, size, sectOfBlock, coverage, checkPoints, progress, deadline, scheduler):
+        # Execute the disk IO tests against all the paths to the LUN with SCSI
+        # ID key with blocks of sectOfBlock sectors, counting the checkpoints
+        # passed and in all into checkPoints, and passing the progress of the
+        # tests on to the progress reporter. The disk IO test stops at the
+        # time the deadline planner grants it, less the time of the mixed test.
+        Print("     - Testing LUN with SCSI ID %-30s" % key)
+        checkPoints[1] += 1
+        overhead = 0
+        if self.readPercent is not None:
+            overhead = StorageHandlerUtil.DDT_MIXED_TIME
+        testTime = deadline.TestTime(key, scheduler.GetConcurrency(), overhead)
+        try:
+            pathPassed = StorageHandlerUtil.DiskIOTestPaths(devices, size, coverage,
+                                                            self.rateMBps, self.rateIOPS, sectOfBlock,
+                                                            functools.partial(progress.Update, key), testTime)
+            if pathPassed == 0:
+                displayOperationStatus(False)
+                raise Exception("     - LUN with SCSI ID %-30s. Failed the IO test, none of the paths were writable." % key)
+            else:
+                Print("        SCSI ID: %s Total paths: %d. Writable paths: %d." % (key, len(devices), pathPassed))
+                displayOperationStatus(True)
+                checkPoints[0] += 1
+
+            if self.readPercent is not None:
+                checkPoints[1] += 1
+                if not StorageHandlerUtil.DiskIOTestMixed(devices, size, self.readPercent,
+                                                          sectOfBlock, self.rateMBps, self.rateIOPS):
+                    raise Exception("     - LUN with SCSI ID %-30s. Failed the mixed read/write IO test." % key)
+                checkPoints[0] += 1
+        finally:
+            deadline.Done(key)
+
+    def GetDiskIOTestRunTime(self, luns, estimates):
+        # The estimated seconds of the disk IO tests of the LUNs, given as to
+        # DiskIOTestLUNs, run as many at once as the scheduler may
+        maxJobs = self.concurrentLUNs or StorageHandlerUtil.DDT_MAX_CONCURRENT_LUNS
+        return StorageHandlerUtil.PlanDiskIOTestRunTime([(luns[key][0], estimates.get(key, 0)) for key in luns.keys()], maxJobs)
+
+    def DiskIOTestLUNs(self, luns, estimates, coverage, budget):
+        # Execute the disk IO tests of the LUNs, given as a dict of SCSI ID ->
+        # (groups, devices, size) where groups are the portals or HBAs of its
+        # paths, concurrently on the scheduler, with a report of their progress
+        # every minute, within budget seconds. Without -L, the number of LUNs
+        # tested at once is found by the concurrency controller. Return the
+        # checkpoints passed and in all, and the SCSI ID of the first LUN which
+        # failed or None.
+        # The block size sweeps run one LUN at a time before the disk IO tests,
+        # so that each measures its LUN rather than the tests of the others.
+        start = time.time()
+        sectOfBlocks = {}
+        for key in sorted(luns.keys()):
+            (groups, devices, size) = luns[key]
+            if self.blockSizes:
+                Print("     - Block sizes of LUN with SCSI ID %-30s" % key)
+            sectOfBlocks[key] = self.GetDiskIOTestBlockSize(devices, size)
+
+        progress = StorageHandlerUtil.DiskIOTestProgress()
+        if self.concurrentLUNs:
+            scheduler = StorageHandlerUtil.DiskIOTestScheduler(self.concurrentLUNs, progress=progress)
+            controller = None
+        else:
+            controller = StorageHandlerUtil.DiskIOTestConcurrency()
+            scheduler = StorageHandlerUtil.DiskIOTestScheduler(controller=controller, progress=progress)
+        deadline = StorageHandlerUtil.DiskIOTestDeadline(budget - (time.time() - start))
+        checkPoints = {}
+        for key in luns.keys():
+            (groups, devices, size) = luns[key]
+            checkPoints[key] = [0, 0]
+            deadline.Add(key, estimates.get(key, 0) * coverage)
+            scheduler.Add(key, groups, devices, estimates.get(key, 0) * coverage, self.DiskIOTestLUN,
+                          key, devices, size, sectOfBlocks[key], coverage, checkPoints[key], progress, deadline, scheduler)
+
+        passed = 0
+        total = 0
+        failedKey = None
+        for (key, result, error) in scheduler.Run():
+            passed += checkPoints[key][0]
+            total += checkPoints[key][1]
+            if error is not None and failedKey is None:
+                failedKey = key
+        if controller and len(luns) > 1:
+            Print("   The disk IO tests settled on %d LUNs at once, pass -L %d to test as many at once against this array." % \
+                  (controller.GetLevel(), controller.GetLevel()))
+        return (passed, total, failedKey)
     
     def ControlPathStressTests(self):
         sr_ref = None 
@@ -217,7 +466,11 @@ class StorageHandler(object):
                     Print("SR SPACE RECLAMATION TEST")
                     # Perform TRIM before destroying SR
                     totalCheckPoints += 1
-                    trim_status = self.performSRTrim(sr_ref)
+                    try:
+                        trim_status = self.SpaceReclamationTest(sr_ref)
+                    except Exception, e:
+                        Print("      Space reclamation test failed. Exception: %s" % str(e))
+                        trim_status = False
                     if trim_status:
                         checkPoint += 1
                     Print("      Trim Plugin Status: %s" % (str(trim_status)))
@@ -235,8 +488,7 @@ class StorageHandler(object):
         disableMP = False
         try:
             sr_ref = None
-            vdi_ref = None
-            vbd_ref = None
+            luns = []
             retVal =True
             checkPoint = 0
             totalCheckPoints = 6
@@ -289,126 +541,161 @@ class StorageHandler(object):
             # make sure there are at least 2 paths for the multipath tests to make any sense.
             if len(self.listPathConfig) < 2:
                 raise Exception("FATAL! At least 2 paths are required for multipath failover testing, please configure your storage accordingly.")
-                
-            
-            # Calculate the number of active paths here
-            self.initialActivePaths = 0
-            for tuple in self.listPathConfig:
-                if tuple[1] == 'active':
-                    self.initialActivePaths += 1
+
+            # The LUNs to fail over at once, behind the same paths as the first
+            luns.append(MultipathLUN(self.session, device_config['SCSIid'], sr_ref))
+            if self.mpLUNs > 1:
+                Print("   Creating SRs on %d more LUNs, to fail over %d LUNs at once." % (self.mpLUNs - 1, self.mpLUNs))
+                for (scsiId, lun_sr_ref) in self.CreateMultipathSRs(device_config, self.mpLUNs - 1):
+                    luns.append(MultipathLUN(self.session, scsiId, lun_sr_ref))
+                if len(luns) < self.mpLUNs:
+                    Print("   - Only %d LUNs are available to fail over at once." % len(luns))
+            for lun in luns:
+                lun.Watch()
+                Print("   The timeline of the IO stalls of %s is written to %s," % (lun.scsiid, lun.timeline.csvPath))
+                Print("   and its summary to %s." % lun.timeline.jsonPath)
+            self.timelines = [lun.timeline for lun in luns]
             
             # Now testing failure times for the paths.  
-            (retVal, vdi_ref, vbd_ref, vdi_size) = StorageHandlerUtil.CreateMaxSizeVDIAndVBD(self.session, sr_ref)
-            if not retVal:
-                raise Exception("Failed to create max size VDI and VBD.")
-            else:
-                checkPoint += 2
+            for lun in luns:
+                lun.Attach()
+            checkPoint += 2
            
-            global retValIO
-            global timeTaken
-            global bytesCopied
-            global speedOfCopy
             Print("")
             Print("Iteration 1:\n")
             Print(" -> No manual/script blocking of paths.")
-            s = TimedDeviceIO(self.session.xenapi.VBD.get_device(vbd_ref))
-            s.start()
-            s.join()
-            
-            if retValIO != 0:
-                displayOperationStatus(False)
-                raise Exception(" IO tests failed for device: %s" % self.session.xenapi.VBD.get_device(vbd_ref))
+            # One prober on each LUN writes to its VBD through all the iterations
+            for lun in luns:
+                lun.timeline.StartIteration(1, lun.fullPaths)
+                lun.StartProber()
+            time.sleep(probeBaselineTime)
+            results = [(lun,) + lun.prober.Collect() for lun in luns]
+            for (lun, ios, maxTimeTaken, maxStart) in results:
+                if lun.prober.error is not None or ios == 0:
+                    displayOperationStatus(False)
+                    raise Exception(" IO tests failed for device: %s" % self.session.xenapi.VBD.get_device(lun.vbd_ref))
+            ios = sum([result[1] for result in results])
+            maxTimeTaken = max([result[2] for result in results])
             
-            initialDataCopyTime = float(timeTaken.split()[0])
-            if initialDataCopyTime > 3:
-                displayOperationStatus(False, timeTaken)
-                Print("    - The initial data copy is too slow at %s" % timeTaken )
+            if maxTimeTaken > 3:
+                displayOperationStatus(False, "%.3f s" % maxTimeTaken)
+                Print("    - The initial data copy is too slow at %.3f s" % maxTimeTaken)
                 dataCopyTooSlow = True
             else:
-                Print("    - IO test passed. Time: %s. Data: %s. Throughput: %s" % (timeTaken, '1MB', speedOfCopy))
+                Print("    - IO test passed. Writes: %d. Longest time: %.3f s. Data: %s. Throughput: %.1f MB/s" % \
+                      (ios, maxTimeTaken, '1MB', probeBlockSize / maxTimeTaken / StorageHandlerUtil.MiB))
                 displayOperationStatus(True)
                 checkPoint += 1
+            for lun in luns:
+                lun.EndIteration()
 
             if len(self.listPathConfig) > 1:
                 for i in range(2, iterationCount):
-                    maxTimeTaken = 0
-                    throughputForMaxTime = ''
                     totalCheckPoints += 2
                     Print("Iteration %d:\n" % i)
+                    for lun in luns:
+                        lun.timeline.StartIteration(i, lun.fullPaths)
 
                     if isManBlock:
                         Print(" -> Wait for manually blocking paths")
                         self.WaitManualBlockUnblockPaths()
-                        devicesToFail = 1
                         checkFunc = operator.ge
+                        blockTime = StorageHandlerUtil.MonotonicTime()
                     else:
+                        blockTime = StorageHandlerUtil.MonotonicTime()
                         if not self.RandomlyFailPaths():
                             raise Exception("Failed to block paths.")
 
                         XenCertPrint("Dev Path Config = '%s', no of Blocked switch Paths = '%s'" % (self.listPathConfig, self.noOfPaths))
+                        checkFunc = operator.eq
 
+                    # The writes before the failover started are not of this iteration
+                    for lun in luns:
+                        lun.prober.Collect()
+                    failovers = []
+                    for lun in luns:
+                        if isManBlock:
+                            devicesToFail = 1
                         # Fail path calculation needs to be done only in case of hba SRs
-                        if "blockunblockhbapaths" in \
+                        elif "blockunblockhbapaths" in \
                                 self.storage_conf['pathHandlerUtil'].split('/')[-1]:
                             #Calculate the number of devices to be found after the path block
-                            devicesToFail = (len(self.listPathConfig)/self.noOfTotalPaths) * self.noOfPaths
-                            XenCertPrint("Expected devices to fail: %s" % devicesToFail)
+                            devicesToFail = (lun.totalPaths/self.noOfTotalPaths) * self.noOfPaths
                         else:
                             devicesToFail = self.noOfPaths
-                        checkFunc = operator.eq
-
-                    s = WaitForFailover(self.session, device_config['SCSIid'], len(self.listPathConfig), devicesToFail, checkFunc)
-                    s.start()
-
-                    while s.isAlive():
-                        timeTaken = 0
-                        s1 = TimedDeviceIO(self.session.xenapi.VBD.get_device(vbd_ref))                    
-                        s1.start()
-                        s1.join()
-                        
-                        if retValIO != 0:                        
+                        XenCertPrint("Expected devices of %s to fail: %s" % (lun.scsiid, devicesToFail))
+                        # Wait for the expected number of paths to fail, timed from the block
+                        failovers.append(lun.watcher.WaitFor(lambda activePaths: checkFunc(lun.totalPaths - activePaths, devicesToFail),
+                                                             failoverTimeout, blockTime))
+                    results = [(_lun, _failover) + _lun.prober.Collect() for (_lun, _failover) in zip(luns, failovers)]
+
+                    for (lun, failoverTime, ios, maxTimeTaken, maxStart) in results:
+                        if lun.prober.error is not None:
                             displayOperationStatus(False)
-                            raise Exception("    - IO test failed for device %s." % self.session.xenapi.VBD.get_device(vbd_ref))
-                        else:
-                            XenCertPrint("    - IO test passed. Time: %s. Data: %s. Throughput: %s." % (timeTaken, '1MB', speedOfCopy))
-                            
-                        if timeTaken > maxTimeTaken:
-                            maxTimeTaken = timeTaken
-                            throughputForMaxTime = speedOfCopy
-
-                    if pathsFailed:
-                        Print("    - Paths failover time: %s seconds" % failoverTime)
-                        Print("    - Maximum IO completion time: %s. Data: %s. Throughput: %s" % (maxTimeTaken, '1MB', throughputForMaxTime))
+                            lun.prober.Check()
+                        XenCertPrint("    - IO test of %s passed. Writes: %d. Longest time: %f s, started at %s." % \
+                                     (lun.scsiid, ios, maxTimeTaken, maxStart))
+                        if failoverTime is None:
+                            continue
+                        if len(luns) > 1:
+                            Print("    LUN %s:" % lun.scsiid)
+                        Print("    - Paths failover time: %.3f seconds" % failoverTime)
+                        Print("    - Maximum IO completion time: %.3f s. Data: %s. Throughput: %.1f MB/s" % \
+                              (maxTimeTaken, '1MB', probeBlockSize / max(maxTimeTaken, 1e-6) / StorageHandlerUtil.MiB))
+
+                    failed = [_lun.scsiid for (_lun, _failover) in zip(luns, failovers) if _failover is None]
+                    if len(luns) > 1:
+                        Print("    All %d LUNs:" % len(luns))
+                        Print("    - Paths failed over on %d LUNs. Longest failover time: %.3f seconds" % \
+                              (len(luns) - len(failed), max([_failover for _failover in failovers if _failover is not None] or [0])))
+                        Print("    - Maximum IO completion time: %.3f s" % max([result[3] for result in results]))
+                    if not failed:
                         displayOperationStatus(True)
                         checkPoint += 1
                     else:
                         displayOperationStatus(False)
                         if not isManBlock:
                             self.BlockUnblockPaths(False, self.storage_conf['pathHandlerUtil'], self.noOfPaths, self.blockedpathinfo)
-                        raise Exception("    - Paths did not failover within expected time.")
+                        raise Exception("    - Paths did not failover within expected time on %s." % ', '.join(failed))
 
                     if isManBlock:
                         Print(" -> Wait for manually unblocking paths and restoration")
                         self.WaitManualBlockUnblockPaths()
+                        unblockTime = StorageHandlerUtil.MonotonicTime()
                     else:
+                        unblockTime = StorageHandlerUtil.MonotonicTime()
                         self.BlockUnblockPaths(False, self.storage_conf['pathHandlerUtil'], self.noOfPaths, self.blockedpathinfo)
                         Print(" -> Unblocking paths, waiting for restoration.")
 
-                    count = 0
-                    pathsMatch = False
-                    while not pathsMatch and count < 120:
-                        pathsMatch = self.DoNewPathsMatch(device_config)
-                        time.sleep(1)
-                        count += 1
-                        
-                    if not pathsMatch:
+                    restores = []
+                    for lun in luns:
+                        restoreTime = lun.watcher.WaitFor(lambda activePaths: activePaths >= lun.fullPaths,
+                                                          restoreTimeout, unblockTime)
+                        restores.append(restoreTime)
+                        if len(luns) > 1 and restoreTime is not None:
+                            Print("    - Paths of LUN %s restored in %.3f seconds" % (lun.scsiid, restoreTime))
+                    failed = [_lun.scsiid for (_lun, _restore) in zip(luns, restores) if _restore is None]
+                    if failed:
                         displayOperationStatus(False, "> 2 mins")
                         retVal = False 
-                        raise Exception("The path restoration took more than 2 mins.")
+                        raise Exception("The path restoration took more than 2 mins on %s." % ', '.join(failed))
                     else:
-                        displayOperationStatus(True, " " + str(count) + " seconds")
+                        displayOperationStatus(True, " %.3f seconds" % max(restores))
                         checkPoint += 1
 
+                    # The writes of the restoration are of this iteration too
+                    summaries = []
+                    for lun in luns:
+                        summary = lun.EndIteration()
+                        summaries.append(summary)
+                        if len(luns) > 1:
+                            Print("    - LUN %s: %s" % (lun.scsiid, StorageHandlerUtil.FormatIOStallSummary(summary)))
+                        else:
+                            Print("    - %s" % StorageHandlerUtil.FormatIOStallSummary(summary))
+                    if len(luns) > 1:
+                        Print("    - All %d LUNs: %s" % (len(luns), StorageHandlerUtil.FormatIOStallSummary(
+                              StorageHandlerUtil.MergeIOStallSummaries(summaries))))
+
             Print("- Test succeeded.")
  
         except Exception, e:
@@ -419,17 +706,15 @@ class StorageHandler(object):
 
         try:
             # Try cleaning up here
-            if vbd_ref is not None:
-                self.session.xenapi.VBD.unplug(vbd_ref)
-                XenCertPrint("Unplugged VBD %s" % vbd_ref)
-                self.session.xenapi.VBD.destroy(vbd_ref)
-                XenCertPrint("Destroyed VBD %s" % vbd_ref)
-
-            if vdi_ref is not None:
-                self.session.xenapi.VDI.destroy(vdi_ref)
-                XenCertPrint("Destroyed VDI %s" % vdi_ref)
+            for lun in luns:
+                lun.Cleanup()
+            self.timelines = []
 
             # Try cleaning up here
+            for lun in luns[1:]:
+                Print("      Destroy the SR on %s." % lun.scsiid)
+                StorageHandlerUtil.DestroySR(self.session, lun.sr_ref)
+                lun.sr_ref = None
             if sr_ref is not None:
                 Print("      Destroy the SR.")
                 StorageHandlerUtil.DestroySR(self.session, sr_ref)
@@ -441,7 +726,8 @@ class StorageHandler(object):
             checkPoint += 1
                 
         except Exception, e:
-            Print("- Could not cleanup the objects created during testing, VBD: %s VDI:%s SR:%s. Please destroy the objects manually. Exception: %s" % (vbd_ref, vdi_ref, sr_ref, str(e)))
+            Print("- Could not cleanup the objects created during testing, VBDs: %s VDIs: %s SRs: %s. Please destroy the objects manually. Exception: %s" % \
+                  ([lun.vbd_ref for lun in luns], [lun.vdi_ref for lun in luns], [sr_ref] + [lun.sr_ref for lun in luns[1:]], str(e)))
             displayOperationStatus(False)
 
         XenCertPrint("Checkpoints: %d, totalCheckPoints: %s" % (checkPoint, totalCheckPoints))
@@ -663,7 +949,10 @@ class StorageHandler(object):
             else:
                 cmd = [os.path.join(os.getcwd(), script), 'unblock', str(noOfPaths), passthrough]
             
+            start = StorageHandlerUtil.MonotonicTime()
             (rc, stdout, stderr) = util.doexec(cmd,'')
+            for timeline in self.timelines:
+                timeline.AddCallout(cmd[1], start, StorageHandlerUtil.MonotonicTime())
 
             stdoutPrint = hidePathInfoPassword(stdout) if self.storage_conf['storage_type'] == 'hba' else stdout
             XenCertPrint("The path block/unblock utility returned rc: %s stdout: '%s', stderr: '%s'" % (rc, stdoutPrint, stderr))
@@ -673,10 +962,16 @@ class StorageHandler(object):
         except Exception, e:            
             raise e
 
+    def CreateMultipathSRs(self, device_config, count):
+        raise Exception("The multipath tests cannot fail over several LUNs at once for storage type %s." % self.storage_conf['storage_type'])
+
     def WaitManualBlockUnblockPaths(self):
         try:
             cmd = [self.storage_conf['pathHandlerUtil']]
+            start = StorageHandlerUtil.MonotonicTime()
             (rc, stdout, stderr) = util.doexec(cmd, '')
+            for timeline in self.timelines:
+                timeline.AddCallout('manual', start, StorageHandlerUtil.MonotonicTime())
             XenCertPrint(
                 "The path manually block/unblock utility returned rc: %s stdout: '%s', stderr: '%s'" % (rc, stdout, stderr))
             if rc != 0:
@@ -693,28 +988,6 @@ class StorageHandler(object):
         # This class specific function will create an SR of the required type and return the required parameters.
         XenCertPrint("Reached StorageHandler Create")
         
-    def DoNewPathsMatch(self, device_config):
-        try:
-            # get new config
-            (retVal, listPathConfigNew) = StorageHandlerUtil.get_path_status(device_config['SCSIid'])
-            XenCertPrint("listpathconfig: %s" % self.listPathConfig)
-            XenCertPrint("listpathconfigNew: %s" % listPathConfigNew)
-            if not retVal:                
-                raise Exception("     - Failed to get path status information for SCSI Id: %s" % device_config['SCSIid'])
-            
-            # Find new number of active paths
-            newActivePaths = 0
-            for tuple in listPathConfigNew:
-                if tuple[1] == 'active':
-                    newActivePaths += 1
-            
-            if newActivePaths < self.initialActivePaths:                            
-                    return False
-            return True
-        except Exception, e:
-            XenCertPrint("Failed to match new paths with old paths.")
-            return False
-        
     def populateVDI_XAPIFields(self, vdi_ref):
         fields = self.session.xenapi.VDI.get_all_records()[vdi_ref]
         for key in self.KEYS_NOT_POPULATED_BY_THE_STORAGE:
@@ -1902,6 +2175,26 @@ class BlockStorageHandler(StorageHandler):
 
         return True
 
+    def _CreateMultipathSRs(self, device_config, listSCSIId, count, srType, shared):
+        # Create SRs on up to count of the LUNs other than that of device_config,
+        # skipping those an SR cannot be created on, and return them as a list
+        # of (SCSI ID, SR)
+        srs = []
+        for scsiId in listSCSIId:
+            if len(srs) == count:
+                break
+            if scsiId == device_config['SCSIid'] or scsiId in [item[0] for item in srs]:
+                continue
+            config = copy.copy(device_config)
+            config['SCSIid'] = scsiId
+            try:
+                sr_ref = self.session.xenapi.SR.create(util.get_localhost_uuid(self.session), config, '0', 'XenCertTestSR', '', srType, '', shared, {})
+                XenCertPrint("Created the SR %s on %s for the multipath tests" % (sr_ref, scsiId))
+                srs.append((scsiId, sr_ref))
+            except Exception, e:
+                XenCertPrint("Could not create an SR on %s for the multipath tests, trying other devices. Exception: %s" % (scsiId, str(e)))
+        return srs
+
     def DisableClustering(self):
         """
         If we enabled clustering disable it afterwards
@@ -2193,6 +2486,11 @@ class StorageHandlerISCSI(BlockStorageHandler):
         
         return (retVal, sr_ref, device_config)
         
+    def CreateMultipathSRs(self, device_config, count):
+        # More SRs for the multipath tests, on the other LUNs of the target
+        (listPortal, listSCSIId) = StorageHandlerUtil.GetListPortalScsiIdForIqn(self.session, self.storage_conf['target'], self.iqn, self.storage_conf['chapuser'], self.storage_conf['chappasswd'])
+        return self._CreateMultipathSRs(device_config, listSCSIId, count, 'lvmoiscsi', True)
+
     def GetPathStatus(self, device_config):
         # Query DM-multipath status, reporting a) Path checker b) Path Priority handler c) Number of paths d) distribution of active vs passive paths
         try:
@@ -2257,8 +2555,10 @@ class StorageHandlerISCSI(BlockStorageHandler):
         checkPoint = 0
         totalCheckPoints = 4
         timeForIOTestsInSec = 0
+        timeForLUNTests = {}
         totalSizeInMiB = 0
         wildcard = False
+        startTime = time.time()
 
         try:
             # Take SR device-config parameters and initialise data path layer.        
@@ -2356,7 +2656,6 @@ class StorageHandlerISCSI(BlockStorageHandler):
                         sectors = util.get_single_entry(filelist[0])
                         size = int(sectors) * 512 / 1024 / 1024
                         Print("     %-23s\t%-4s\t%-34s\t%-10s" % (portal, key, lunToScsi[key][0], size))
-                        timeForIOTestsInSec += StorageHandlerUtil.FindDiskDataTestEstimate(lunToScsi[key][1], size)
                         if scsiToTupleMap.has_key(lunToScsi[key][0]):
                             scsiToTupleMap[lunToScsi[key][0]].append(( portal, iqn, lunToScsi[key][1], size))
                         else:
@@ -2374,6 +2673,12 @@ class StorageHandlerISCSI(BlockStorageHandler):
                         raise Exception("     ERROR: LUNs reported by portal %s for iqn %s do not match LUNs reported by other portals of the same IQN." % (portal, iqn))
                 else:
                     iqnToScsiList[iqn] = scsilist
+
+            # Estimate the time of the disk IO tests of all the LUNs at once
+            lunPaths = {}
+            for key in scsiToTupleMap.keys():
+                lunPaths[key] = [(path[2], path[3]) for path in scsiToTupleMap[key]]
+            timeForLUNTests = StorageHandlerUtil.FindDiskDataTestEstimates(lunPaths, self.rateMBps, self.rateIOPS)
                         
             displayOperationStatus(True)
             checkPoint += 1
@@ -2383,6 +2688,17 @@ class StorageHandlerISCSI(BlockStorageHandler):
             Print("   that they are writeable and there is no apparent disk corruption.")
             Print("   the tests attempt to write to the LUN over each available path and")
             Print("   reports the number of writable paths to each LUN.")
+            # The LUNs are tested concurrently, at most a few through each portal
+            luns = {}
+            for key in scsiToTupleMap.keys():
+                luns[key] = ([path[0] for path in scsiToTupleMap[key]], [path[2] for path in scsiToTupleMap[key]],
+                             scsiToTupleMap[key][0][3])
+            timeForIOTestsInSec = self.GetDiskIOTestRunTime(luns, timeForLUNTests)
+            budget = timeLimitFunctional * 3600 - (time.time() - startTime)
+            coverage = StorageHandlerUtil.GetDiskDataTestCoverage(timeForIOTestsInSec, budget)
+            if coverage < 1:
+                Print("   To finish within %d hours, the tests sample %.3f%% of the blocks of each LUN." % (timeLimitFunctional, coverage * 100))
+                timeForIOTestsInSec = int(timeForIOTestsInSec * coverage)
             seconds = timeForIOTestsInSec
             minutes = 0
             hrs = 0
@@ -2404,55 +2720,11 @@ class StorageHandlerISCSI(BlockStorageHandler):
                 Print("   APPROXIMATE RUN TIME: %s seconds." % seconds)
             
             Print("")
-            firstPortal = True
-            lunsMatch = True
-            for key in scsiToTupleMap.keys():                                
-                try:                    
-                    totalCheckPoints += 1
-                    Print("     - Testing LUN with SCSI ID %-30s" % key)
-                    
-                    pathNo = 0
-                    pathPassed = 0
-                    for tuple in scsiToTupleMap[key]:                        
-                        # If this is a root device then skip IO tests for this device.
-                        if os.path.realpath(util.getrootdev()) == tuple[2]:
-                            Print("     -> Skipping IO tests on device %s, as it is the root device." % tuple[2])
-                            continue
-                        
-                        pathNo += 1
-        
-                        # Execute a disk IO test against each path to the LUN to verify that it is writeable
-                        # and there is no apparent disk corruption
-                        PrintOnSameLine("        Path num: %d. Device: %s" % (pathNo, tuple[2]))
-                        try:
-                            # First write a small chunk on the device to make sure it works                    
-                            XenCertPrint("First write a small chunk on the device %s to make sure it works." % tuple[2])
-                            cmd = ['dd', 'if=/dev/zero', 'of=%s' % tuple[2], 'bs=1M', 'count=1', 'conv=nocreat', 'oflag=direct']
-                            util.pread(cmd)
-                            
-                            XenCertPrint("lun size: %d MB" % tuple[3])
-                            StorageHandlerUtil.DiskDataTest(tuple[2], StorageHandlerUtil.GetBlocksNum(tuple[3]))
-
-                            XenCertPrint("Device %s passed the disk IO test. " % tuple[2])
-                            pathPassed += 1
-                            Print("")
-                            displayOperationStatus(True)
-                            
-                        except Exception, e:  
-                            Print("        Exception: %s" % str(e))
-                            displayOperationStatus(False)
-                            XenCertPrint("Device %s failed the disk IO test. Please check if the disk is writable." % tuple[2] )
-                        
-                    if pathPassed == 0:
-                        displayOperationStatus(False)
-                        raise Exception("     - LUN with SCSI ID %-30s. Failed the IO test, none of the paths were writable." % key)                        
-                    else:
-                        Print("        SCSI ID: %s Total paths: %d. Writable paths: %d." % (key, len(scsiToTupleMap[key]), pathPassed))
-                        displayOperationStatus(True)
-                        checkPoint += 1                            
-                                
-                except Exception, e:                    
-                    raise Exception("   - Testing failed while testing devices with SCSI ID: %s." % key)
+            (passed, total, failedKey) = self.DiskIOTestLUNs(luns, timeForLUNTests, coverage, budget)
+            checkPoint += passed
+            totalCheckPoints += total
+            if failedKey is not None:
+                raise Exception("   - Testing failed while testing devices with SCSI ID: %s." % failedKey)
                 
             Print("   END TIME: %s " % (time.asctime(time.localtime())))
             
@@ -2530,6 +2802,16 @@ class StorageHandlerHBA(BlockStorageHandler):
 
         return (retVal, sr_ref, device_config)
 
+    def CreateMultipathSRs(self, device_config, count):
+        # More SRs for the multipath tests, on the other SCSI IDs to test
+        (retVal, listAdapters, listSCSIId) = StorageHandlerUtil. \
+                                           GetHBAInformation(self.session, \
+                                           self.storage_conf, sr_type=self.sr_type)
+        if not retVal:
+            raise Exception("   - Failed to get available HBA information on the host.")
+        listSCSIId = [scsiId for scsiId in self.storage_conf['scsiIDs'].split(',') if scsiId in listSCSIId]
+        return self._CreateMultipathSRs(device_config, listSCSIId, count, self.sr_type, False)
+
     def GetPathStatus(self, device_config):
         # Query DM-multipath status, reporting a) Path checker b) Path Priority handler c) Number of paths d) distribution of active vs passive paths
         try:            
@@ -2589,10 +2871,10 @@ class StorageHandlerHBA(BlockStorageHandler):
         retVal = True
         checkPoint = 0
         totalCheckPoints = 4
-        timeForIOTestsInSec = 0
         totalTimeForIOTestsInSec = 0
         totalSizeInMiB = 0
         scsiIdList = self.storage_conf['scsiIDs'].split(",")
+        startTime = time.time()
 
         try:
             # 1. Report the FC Host Adapters detected and the status of each physical port
@@ -2641,6 +2923,8 @@ class StorageHandlerHBA(BlockStorageHandler):
             hostIdToLunList = {}
             # map from SCSI id -> list of devices
             scsiToTupleMap = {}
+            # and from SCSI id -> list of the host ids of its devices
+            scsiToHostIds = {}
             # Create a map of the format SCSIid -> [size, time]
             # this is used to store size of the disk and the calculated time it takes to perform disk IO tests
             scsiInfo = {}
@@ -2709,17 +2993,14 @@ class StorageHandlerHBA(BlockStorageHandler):
                         size = int(sectors) * 512 / 1024 / 1024
                         Print("     %-4s\t%-34s\t%-20s\t%-10s" % (lun['id'], lun['SCSIid'], lun['device'], size))
 
-                        timeForIOTestsInSec = 0
-                        # Estimate test for only specified lun
-                        if lun['SCSIid'] in scsiIdList:
-                            timeForIOTestsInSec = StorageHandlerUtil.FindDiskDataTestEstimate(lun['device'], size)
                         if scsiToTupleMap.has_key(lun['SCSIid']):
                             scsiToTupleMap[lun['SCSIid']].append((lun['device'], size))
+                            scsiToHostIds[lun['SCSIid']].append(map['id'])
                             scsiInfo[lun['SCSIid']][0] += size
-                            scsiInfo[lun['SCSIid']][1] += timeForIOTestsInSec
                         else:
                             scsiToTupleMap[lun['SCSIid']] = [(lun['device'], size)]
-                            scsiInfo[lun['SCSIid']] = [size,timeForIOTestsInSec]
+                            scsiToHostIds[lun['SCSIid']] = [map['id']]
+                            scsiInfo[lun['SCSIid']] = [size, 0]
         
 
                 except Exception, e:
@@ -2727,6 +3008,15 @@ class StorageHandlerHBA(BlockStorageHandler):
                     continue
                 displayOperationStatus(True)
 
+            # Estimate the time of the disk IO tests of only the specified LUNs, all at once
+            lunPaths = {}
+            for key in scsiToTupleMap.keys():
+                if key in scsiIdList:
+                    lunPaths[key] = scsiToTupleMap[key]
+            estimates = StorageHandlerUtil.FindDiskDataTestEstimates(lunPaths, self.rateMBps, self.rateIOPS)
+            for key in estimates.keys():
+                scsiInfo[key][1] = estimates[key]
+
             checkPoint += 1
 
             # 3. Execute a disk IO test against each LUN to verify that they are writeable and there is no apparent disk corruption            
@@ -2743,12 +3033,24 @@ class StorageHandlerHBA(BlockStorageHandler):
                 if key in scsiIdList:
                     scsiIdsToTest[key] = value
                     totalSizeInMiB += scsiInfo[key][0]
-                    totalTimeForIOTestsInSec += scsiInfo[key][1]
 
             # Check if the entered list contains invalid SCSIid entries
             if len(scsiIdsToTest) != len(scsiIdList):
                 raise Exception("One or more SCSI-ID that was entered is invalid")
 
+            # The LUNs are tested concurrently, at most a few through each HBA
+            luns = {}
+            estimates = {}
+            for key in scsiIdsToTest.keys():
+                luns[key] = (scsiToHostIds[key], [device for (device, _) in scsiIdsToTest[key]],
+                             scsiIdsToTest[key][0][1])
+                estimates[key] = scsiInfo[key][1]
+            totalTimeForIOTestsInSec = self.GetDiskIOTestRunTime(luns, estimates)
+            budget = timeLimitFunctional * 3600 - (time.time() - startTime)
+            coverage = StorageHandlerUtil.GetDiskDataTestCoverage(totalTimeForIOTestsInSec, budget)
+            if coverage < 1:
+                Print("   To finish within %d hours, the tests sample %.3f%% of the blocks of each LUN." % (timeLimitFunctional, coverage * 100))
+                totalTimeForIOTestsInSec = int(totalTimeForIOTestsInSec * coverage)
             seconds = totalTimeForIOTestsInSec
             minutes = 0
             hrs = 0
@@ -2770,52 +3072,11 @@ class StorageHandlerHBA(BlockStorageHandler):
             
             Print("")            
             totalCheckPoints += 1
-            for key in scsiIdsToTest.keys():
-                try:
-                    totalCheckPoints += 1
-                    Print("     - Testing LUN with SCSI ID %-30s" % key)
-
-                    pathNo = 0
-                    pathPassed = 0
-                    for device,size in scsiIdsToTest[key]:
-                        # If this is a root device then skip IO tests for this device.
-                        if os.path.realpath(util.getrootdev()) == device:
-                            Print("     -> Skipping IO tests on device %s, as it is the root device." % device)
-                            continue
-
-                        pathNo += 1
-                        
-                        # Execute a disk IO test against each path to the LUN to verify that it is writeable
-                        # and there is no apparent disk corruption
-                        PrintOnSameLine("        Path num: %d. Device: %s" % (pathNo, device))
-                        try:
-                            # First write a small chunk on the device to make sure it works
-                            XenCertPrint("First write a small chunk on the device %s to make sure it works." % device)
-                            cmd = ['dd', 'if=/dev/zero', 'of=%s' % device, 'bs=1M', 'count=1', 'conv=nocreat', 'oflag=direct']
-                            util.pread(cmd)
-                            
-                            XenCertPrint("lun size: %d MB" % size)
-                            StorageHandlerUtil.DiskDataTest(device, StorageHandlerUtil.GetBlocksNum(size))
-                            
-                            XenCertPrint("Device %s passed the disk IO test. " % device)
-                            pathPassed += 1
-                            Print("")
-                            displayOperationStatus(True)
-
-                        except Exception, e:
-                            Print("        Exception: %s" % str(e))
-                            displayOperationStatus(False)
-                            XenCertPrint("Device %s failed the disk IO test. Please check if the disk is writable." % device )
-                    if pathPassed == 0:
-                        displayOperationStatus(False)
-                        raise Exception("     - LUN with SCSI ID %-30s. Failed the IO test, none of the paths were writable." % key)                        
-                    else:
-                        Print("        SCSI ID: %s Total paths: %d. Writable paths: %d." % (key, len(scsiIdsToTest[key]), pathPassed))
-                        displayOperationStatus(True)
-                        checkPoint += 1
-
-                except Exception, e:
-                    raise Exception("   - Testing failed while testing devices with SCSI ID: %s." % key)
+            (passed, total, failedKey) = self.DiskIOTestLUNs(luns, estimates, coverage, budget)
+            checkPoint += passed
+            totalCheckPoints += total
+            if failedKey is not None:
+                raise Exception("   - Testing failed while testing devices with SCSI ID: %s." % failedKey)
 
             Print("   END TIME: %s " % (time.asctime(time.localtime())))
             checkPoint += 1
@@ -3273,6 +3534,8 @@ class StorageHandlerCIFS(StorageHandler):
         sr_ref = None
         vdi_ref = None
         vbd_ref = None
+        # A new pattern, so the verify cannot pass on the data of an earlier run
+        iterStart = random.randint(0, 100000)
 
         try:
             #1) Create SR
@@ -3298,7 +3561,7 @@ class StorageHandlerCIFS(StorageHandler):
             checkPoint += 1
 
             #4) Write known pattern to VDI
-            StorageHandlerUtil.WriteDataToVDI(self.session, vbd_ref, 0, 3)
+            StorageHandlerUtil.WriteDataToVDI(self.session, vbd_ref, 0, 3, iterStart)
             Print("Wrote data to VDI")
             checkPoint += 1
 
@@ -3319,7 +3582,7 @@ class StorageHandlerCIFS(StorageHandler):
             checkPoint += 1
 
             #8) Write known pattern to second 4GB chunk
-            StorageHandlerUtil.WriteDataToVDI(self.session, vbd_ref, 4, 7)
+            StorageHandlerUtil.WriteDataToVDI(self.session, vbd_ref, 4, 7, iterStart)
             Print("Wrote data onto grown portion of the VDI")
             checkPoint += 1
 
@@ -3335,7 +3598,7 @@ class StorageHandlerCIFS(StorageHandler):
             checkPoint += 1
 
             #11) Validate pattern on first and second 4GB chunks
-            StorageHandlerUtil.VerifyDataOnVDI(self.session, vbd_ref, 0, 7)
+            StorageHandlerUtil.VerifyDataOnVDI(self.session, vbd_ref, 0, 7, iterStart)
             Print("Verified data on complete VDI")
             checkPoint += 1
 
@@ -19,8 +19,18 @@ import re
 import time
 import glob
 import random
+import json
+import csv
+import subprocess
+import tempfile
+import ctypes
+import errno
+import socket
+import Queue
+from threading import Thread, Condition, Lock, Event
 import xml.dom.minidom
-from XenCertLog import Print, PrintOnSameLine, XenCertPrint
+import DiskDataPattern
+from XenCertLog import Print, PrintOnSameLine, XenCertPrint, BufferOutput, FlushOutput, GetLogFileName
 from XenCertCommon import displayOperationStatus, getConfigWithHiddenPassword
 import scsiutil
 import util
@@ -40,6 +50,10 @@ timeLimitControlInSec = 18000
 
 MAX_TIMEOUT = 15
 
+NETLINK_KOBJECT_UEVENT = 15     # netlink protocol of the kernel uevents
+UEVENT_KERNEL_GROUP = 1         # multicast group of the uevents sent by the kernel
+PATH_POLL_INTERVAL = 1          # seconds between the polls of the path status without uevents
+
 KiB = 1024
 MiB = KiB * KiB
 GiB = KiB * KiB * KiB
@@ -54,6 +68,28 @@ BUF_ZEROS = "\0" * 512
 DISKDATATEST = '/opt/xensource/debug/XenCert/diskdatatest'
 DDT_SECTOR_SIZE = 512           # one sector size: 512 bytes
 DDT_DEFAULT_BLOCK_SIZE = 512    # one block size: 512 sectors, 256KB
+DDT_DEFAULT_QUEUE_DEPTH = 16    # block IOs kept in flight by each diskdatatest worker
+DDT_DEFAULT_THREADS = 4         # diskdatatest workers, each on its own stripe of blocks
+DDT_PROGRESS_INTERVAL = 10      # seconds between diskdatatest progress records
+DDT_MIN_COVERAGE = 0.001        # least fraction of the blocks sampled by a disk IO test
+DDT_RESUME_RETRIES = 2          # times a failed diskdatatest run is resumed from its checkpoint
+DDT_RESUME_DELAY = 10           # seconds to wait before resuming a failed diskdatatest run
+DDT_EXIT_IO_ERROR = 2           # exit status of diskdatatest when a block IO failed, the only failure resumed
+DDT_SWEEP_BLOCK_SIZES = [8, 16, 128, 512, 2048, 8192]  # block sizes of a sweep, in sectors: 4K to 4M
+DDT_SWEEP_TIME = 10             # seconds of the diskdatatest run of each block size in a sweep
+DDT_MIXED_TIME = 60             # seconds of the mixed read/write diskdatatest run on a LUN
+DDT_ESTIMATE_TIME = 15          # seconds of the diskdatatest run which estimates the time of a LUN
+DDT_ESTIMATE_WORKERS = 4        # LUNs whose time estimates are run at once
+DDT_ESTIMATE_CACHE = '/var/lib/xencert/diskdatatest-estimates.json'
+DDT_ESTIMATE_CACHE_AGE = 7 * 24 * 3600  # seconds a cached time estimate is reused for
+DDT_MAX_CONCURRENT_LUNS = 8     # LUNs whose disk IO tests are run at once
+DDT_MAX_CONCURRENT_LUNS_PER_GROUP = 2   # of them through one portal or HBA
+DDT_CONCURRENCY_INTERVAL = 30   # seconds the throughput of each number of LUNs tested at once is measured
+DDT_CONCURRENCY_GAIN = 0.1      # least rise of the throughput to keep adding LUNs tested at once
+DDT_CONCURRENCY_LATENCY = 2.0   # rise of the latency of an IO at which fewer LUNs are tested at once
+DDT_REPORT_INTERVAL = 60        # seconds between the progress reports of the disk IO tests
+DDT_STALL_TIME = 6 * DDT_PROGRESS_INTERVAL  # seconds without a byte done before a test is reported stalled
+DDT_MIN_TEST_TIME = 60          # least seconds of the disk IO test of a LUN, once the time budget is spent
 
 multiPathDefaultsMap = { 'udev_dir':'/dev',
 			    'polling_interval':'5',
@@ -802,6 +838,296 @@ def get_path_status(scsi_id, onlyActive = False):
 
     return (retVal, list)
 
+def _ParseUevent(data):
+    # The variables of a kernel uevent, "action@devpath\0KEY=value\0..."
+    event = {}
+    for field in data.split('\0')[1:]:
+        if '=' in field:
+            (key, value) = field.split('=', 1)
+            event[key] = value
+    return event
+
+class PathWatcher(Thread):
+    # Watch the number of active paths of the multipath device of a SCSI ID,
+    # timestamping each change on the monotonic clock. The changes come from
+    # the PATH_FAILED and PATH_REINSTATED uevents device-mapper sends, or,
+    # where the uevents cannot be received, from polling get_path_status.
+    # The status is polled as well at the start and whenever uevents were
+    # lost. The changes are kept in transitions, as (time, action, path,
+    # active paths), and passed on to the timeline, if any.
+    def __init__(self, scsiid, timeline=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.scsiid = scsiid
+        self.timeline = timeline
+        self.cond = Condition()
+        self.stopping = Event()
+        self.activePaths = None
+        self.changed = MonotonicTime()
+        self.transitions = []
+        self.sock = None
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            self.sock.bind((0, UEVENT_KERNEL_GROUP))
+            self.sock.settimeout(PATH_POLL_INTERVAL)
+        except Exception, e:
+            XenCertPrint("Cannot receive the kernel uevents, polling the paths of %s instead. Exception: %s" % (scsiid, str(e)))
+            self.sock = None
+
+    def _Poll(self):
+        (retVal, listPaths) = get_path_status(self.scsiid, True)
+        if retVal:
+            self._Update(len(listPaths), 'poll', None)
+
+    def _Update(self, activePaths, action, path):
+        self.cond.acquire()
+        try:
+            if activePaths != self.activePaths:
+                self.changed = MonotonicTime()
+                self.activePaths = activePaths
+                self.transitions.append((self.changed, action, path, activePaths))
+                if self.timeline is not None:
+                    self.timeline.AddPathChange(self.changed, action, path, activePaths)
+                XenCertPrint("Paths of %s: %s %s, %d active paths" % (self.scsiid, action, path, activePaths))
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _IsOurs(self, event):
+        return event.get('DM_NAME') == self.scsiid or event.get('DM_UUID', '').endswith(self.scsiid)
+
+    def run(self):
+        self._Poll()
+        while not self.stopping.isSet():
+            if self.sock is None:
+                time.sleep(PATH_POLL_INTERVAL)
+                self._Poll()
+                continue
+            try:
+                event = _ParseUevent(self.sock.recv(65536))
+            except socket.timeout:
+                continue
+            except socket.error, e:
+                if e.errno != errno.ENOBUFS:
+                    XenCertPrint("Failed to receive the kernel uevents, polling the paths of %s instead. Exception: %s" % \
+                                 (self.scsiid, str(e)))
+                    self.sock.close()
+                    self.sock = None
+                # the socket overflowed and uevents were lost
+                self._Poll()
+                continue
+            if event.get('DM_ACTION') in ['PATH_FAILED', 'PATH_REINSTATED'] and self._IsOurs(event):
+                self._Update(int(event['DM_NR_VALID_PATHS']), event['DM_ACTION'], event.get('DM_PATH'))
+
+    def Stop(self):
+        self.stopping.set()
+        self.join()
+        if self.sock is not None:
+            self.sock.close()
+
+    def WaitFor(self, predicate, timeout, since=None):
+        # Wait until predicate holds for the number of active paths, for up to
+        # timeout seconds from since, the monotonic time to measure from, by
+        # default now. Return the seconds from since to the change which made
+        # predicate hold, or None on the timeout.
+        if since is None:
+            since = MonotonicTime()
+        self.cond.acquire()
+        try:
+            while self.activePaths is None or not predicate(self.activePaths):
+                left = since + timeout - MonotonicTime()
+                if left <= 0:
+                    return None
+                # a timeout, so that an interrupt is not held up by the wait
+                self.cond.wait(min(left, 1))
+            return max(self.changed - since, 0)
+        finally:
+            self.cond.release()
+
+def _FormatSeconds(seconds):
+    if seconds is None:
+        return 'n/a'
+    return '%.3f s' % seconds
+
+def FormatIOStallSummary(summary):
+    return "Longest IO gap: %s. Block to first failed path: %s. Unblock to full restoration: %s." % \
+           (_FormatSeconds(summary['longest_io_gap']), _FormatSeconds(summary['block_to_first_failed_path']),
+            _FormatSeconds(summary['unblock_to_full_restoration']))
+
+def MergeIOStallSummaries(summaries):
+    # The worst of the IO stall summaries of an iteration on several LUNs
+    merged = {}
+    for key in ['longest_io_gap', 'block_to_first_failed_path', 'unblock_to_full_restoration']:
+        values = [summary[key] for summary in summaries if summary[key] is not None]
+        merged[key] = max(values) if values else None
+    return merged
+
+class IOStallTimeline:
+    # The timeline of the multipath tests of a SCSI ID by iteration: every
+    # completed IO of the prober, path state change of the watcher and call
+    # of the path block/unblock utility, on the monotonic clock. At the end
+    # of an iteration its events are appended to a CSV file, and its summary
+    # of the stalls to a JSON file, both named after the XenCert log and the
+    # SCSI ID.
+    CSV_FIELDS = ['iteration', 'time', 'event', 'detail', 'active_paths', 'duration']
+
+    def __init__(self, scsiid, basename=None):
+        if basename is None:
+            basename = os.path.splitext(GetLogFileName() or os.path.join('/tmp', 'XenCert'))[0] + '-' + scsiid
+        self.scsiid = scsiid
+        self.csvPath = basename + '-mp-timeline.csv'
+        self.jsonPath = basename + '-mp-stalls.json'
+        self.lock = Lock()
+        self.start = MonotonicTime()
+        self.started = time.time()
+        self.iteration = None
+        self.iterationStart = None
+        self.fullPaths = None
+        self.ios = []
+        self.paths = []
+        self.callouts = []
+        self.summaries = []
+        f = open(self.csvPath, 'w')
+        try:
+            csv.writer(f).writerow(self.CSV_FIELDS)
+        finally:
+            f.close()
+
+    def StartIteration(self, iteration, fullPaths):
+        # Start to keep the events of an iteration, which restores the paths
+        # to fullPaths active paths
+        self.lock.acquire()
+        self.iteration = iteration
+        self.iterationStart = MonotonicTime()
+        self.fullPaths = fullPaths
+        self.lock.release()
+
+    def AddIOs(self, starts, latencies):
+        self.lock.acquire()
+        self.ios.extend(zip(starts, latencies))
+        self.lock.release()
+
+    def AddPathChange(self, changed, action, path, activePaths):
+        self.lock.acquire()
+        self.paths.append((changed, action, path, activePaths))
+        self.lock.release()
+
+    def AddCallout(self, action, start, end):
+        self.lock.acquire()
+        self.callouts.append((start, action, end - start))
+        self.lock.release()
+
+    def _Summarize(self, end, ios, paths, callouts):
+        # The longest gap between IO completions, from the start of the
+        # iteration to its end, so that a write which never completed counts,
+        # the time from the block to the first failed path, and from the
+        # unblock to the restoration of all the paths
+        completions = [self.iterationStart] + sorted([start + latency for (start, latency) in ios]) + [end]
+        (longestGap, gapStart) = (0, self.iterationStart)
+        for i in range(1, len(completions)):
+            if completions[i] - completions[i - 1] > longestGap:
+                (longestGap, gapStart) = (completions[i] - completions[i - 1], completions[i - 1])
+
+        (blockToFailure, unblockToRestore) = (None, None)
+        blocks = [start for (start, action, duration) in callouts if action == 'block']
+        if blocks:
+            failures = [changed for (changed, action, path, activePaths) in paths \
+                        if changed >= blocks[0] and activePaths < self.fullPaths]
+            if failures:
+                blockToFailure = failures[0] - blocks[0]
+        unblocks = [start for (start, action, duration) in callouts if action == 'unblock']
+        if unblocks:
+            restores = [changed for (changed, action, path, activePaths) in paths \
+                        if changed >= unblocks[0] and activePaths >= self.fullPaths]
+            if restores:
+                unblockToRestore = restores[0] - unblocks[0]
+
+        return {'iteration': self.iteration,
+                'start': self.iterationStart - self.start,
+                'duration': end - self.iterationStart,
+                'ios': len(ios),
+                'max_io_latency': max([latency for (start, latency) in ios] or [0]),
+                'longest_io_gap': longestGap,
+                'longest_io_gap_start': gapStart - self.start,
+                'path_changes': len(paths),
+                'block_to_first_failed_path': blockToFailure,
+                'unblock_to_full_restoration': unblockToRestore}
+
+    def _WriteEvents(self, iteration, ios, paths, callouts):
+        rows = []
+        for (start, latency) in ios:
+            rows.append((start + latency, 'io', '', '', latency))
+        for (changed, action, path, activePaths) in paths:
+            rows.append((changed, 'path', '%s %s' % (action, path or ''), activePaths, ''))
+        for (start, action, duration) in callouts:
+            rows.append((start, 'callout', action, '', duration))
+        rows.sort()
+        f = open(self.csvPath, 'a')
+        try:
+            writer = csv.writer(f)
+            for (when, event, detail, activePaths, duration) in rows:
+                if duration != '':
+                    duration = '%.6f' % duration
+                writer.writerow([iteration, '%.6f' % (when - self.start), event, detail, activePaths, duration])
+        finally:
+            f.close()
+
+    def _WriteSummaries(self):
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(self.jsonPath))
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump({'scsiid': self.scsiid,
+                       'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started)),
+                       'timeline': self.csvPath,
+                       'iterations': self.summaries}, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp, self.jsonPath)
+
+    def EndIteration(self):
+        # Write out the events of the iteration and return the summary of its
+        # stalls, or None when no iteration was started.
+        self.lock.acquire()
+        try:
+            if self.iteration is None:
+                return None
+            end = MonotonicTime()
+            (ios, paths, callouts) = (self.ios, self.paths, self.callouts)
+            (self.ios, self.paths, self.callouts) = ([], [], [])
+            summary = self._Summarize(end, ios, paths, callouts)
+            self.iteration = None
+        finally:
+            self.lock.release()
+
+        self.summaries.append(summary)
+        try:
+            self._WriteEvents(summary['iteration'], ios, paths, callouts)
+            self._WriteSummaries()
+        except Exception, e:
+            XenCertPrint("Failed to write the IO stall timeline of iteration %d: %s" % (summary['iteration'], str(e)))
+        XenCertPrint("IO stall summary of %s: %s" % (self.scsiid, summary))
+        return summary
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+CLOCK_MONOTONIC = 1
+try:
+    _clock_gettime = ctypes.CDLL('librt.so.1', use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+except Exception, e:
+    _clock_gettime = None
+
+def MonotonicTime():
+    # Seconds of the monotonic clock, which does not jump with the time of
+    # day, or of the time of day where it cannot be read
+    if _clock_gettime is None:
+        return time.time()
+    t = _Timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+        return time.time()
+    return t.tv_sec + t.tv_nsec * 1e-9
+
 def _get_localhost_uuid():
     filename = '/etc/xensource-inventory'
     try:
@@ -814,51 +1140,996 @@ def _get_localhost_uuid():
         domid = line.split("'")[1]
     return domid
 
-def DiskDataTest(device, test_blocks, sect_of_block=DDT_DEFAULT_BLOCK_SIZE, test_time=0):
-    iter_start = str(random.randint(0, 100000))
-    
-    cmd = [DISKDATATEST, 'write', device, str(sect_of_block), str(test_blocks), str(test_time), iter_start]
+def _StreamDiskDataTest(cmd, name, status=None):
+    # Run diskdatatest and yield the JSON records it prints as they come, then
+    # a figures record with the figures of its final line when it exits. Its
+    # exit status is appended to the list status, if any. Closing the
+    # generator kills a run still going.
     XenCertPrint("The command to be fired is: %s" % cmd)
-    (rc, stdout, stderr) = util.doexec(cmd)
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors, close_fds=True)
+    lastString = ''
+    try:
+        # readline, as iterating the pipe reads ahead and holds the records back
+        for line in iter(proc.stdout.readline, ''):
+            line = line.strip()
+            if line.startswith('{'):
+                try:
+                    yield json.loads(line)
+                    continue
+                except ValueError:
+                    pass
+            if line:
+                XenCertPrint("diskdatatest returned : %s" % line)
+                lastString = line
+        rc = proc.wait()
+        if status is not None:
+            status.append(rc)
+    finally:
+        if proc.returncode is None:
+            XenCertPrint("Killing diskdatatest %s on abort" % name)
+            proc.kill()
+            proc.wait()
+        errors.seek(0)
+        stderr = errors.read()
+        errors.close()
+        if stderr:
+            XenCertPrint("diskdatatest error output: %s" % stderr)
+
     if rc != 0:
-        raise Exception("Disk test write error!")
+        raise Exception("Disk test %s error!" % name)
+    yield {'type': 'figures', 'figures': lastString.split()}
+
+def _ResumeDiskDataTest(options, args, name):
+    # Run diskdatatest like _StreamDiskDataTest, saving its progress in a
+    # checkpoint file. When a block IO of a run fails, e.g. on a path blip,
+    # resume it from the checkpoint instead of starting over, up to
+    # DDT_RESUME_RETRIES times. Any other failure would only fail again.
+    (fd, checkpoint) = tempfile.mkstemp(prefix='diskdatatest-', suffix='.ckpt')
+    os.close(fd)
+    resume = []
+    try:
+        for attempt in range(DDT_RESUME_RETRIES + 1):
+            cmd = [DISKDATATEST] + options + ['-c', checkpoint] + resume + args
+            status = []
+            try:
+                for record in _StreamDiskDataTest(cmd, name, status=status):
+                    yield record
+                return
+            except Exception, e:
+                if attempt == DDT_RESUME_RETRIES or status != [DDT_EXIT_IO_ERROR] or \
+                   os.path.getsize(checkpoint) == 0:
+                    raise
+                XenCertPrint("%s Resuming the disk test %s from %s in %d seconds." % (str(e), name, checkpoint, DDT_RESUME_DELAY))
+                time.sleep(DDT_RESUME_DELAY)
+                resume = ['-R']
+    finally:
+        for path in [checkpoint, checkpoint + '.tmp']:
+            if os.path.exists(path):
+                os.unlink(path)
+
+def _DiskDataTestOptions(queue_depth, direct, threads, progress_interval, rate_mbps, rate_iops):
+    options = ['-q', str(queue_depth), '-t', str(threads), '-p', str(progress_interval)]
+    if direct:
+        options.append('-d')
+    if rate_mbps > 0:
+        options.extend(['-b', str(rate_mbps)])
+    if rate_iops > 0:
+        options.extend(['-i', str(rate_iops)])
+    return options
+
+def _RunDiskDataTest(device, test_blocks, sect_of_block, test_time, options, iter_start, pipelined):
+    # Write and verify test_blocks blocks of the device in the order set by
+    # options. Yield the progress records of the run, then a result record
+    # with its figures, taken from the figures records of diskdatatest.
+    if pipelined:
+        args = ['writeverify', device, str(sect_of_block), str(test_blocks), str(test_time), str(iter_start)]
+        for record in _ResumeDiskDataTest(options, args, 'write and verify'):
+            if record['type'] == 'figures':
+                figures = record['figures']
+            else:
+                yield record
 
-    XenCertPrint("diskdatatest returned : %s" % stdout)
-    lastString = stdout.strip().splitlines()[-1]
-    total_blocks, write_blocks, write_elapsed, _ = lastString.split()
-    total_blocks, write_blocks, write_elapsed = int(total_blocks), int(write_blocks), float(write_elapsed)
+        total_blocks, write_blocks, write_elapsed, sector_errors, verify_blocks, verify_elapsed = figures
+        total_blocks, write_blocks, write_elapsed = int(total_blocks), int(write_blocks), float(write_elapsed)
+        verify_blocks, verify_elapsed, sector_errors = int(verify_blocks), float(verify_elapsed), int(sector_errors)
+    else:
+        args = ['write', device, str(sect_of_block), str(test_blocks), str(test_time), str(iter_start)]
+        for record in _ResumeDiskDataTest(options, args, 'write'):
+            if record['type'] == 'figures':
+                figures = record['figures']
+            else:
+                yield record
 
-    cmd = [DISKDATATEST, 'verify', device, str(sect_of_block), str(write_blocks), str(test_time), iter_start]
-    XenCertPrint("The command to be fired is: %s" % cmd)
-    (rc, stdout, stderr) = util.doexec(cmd)
-    if rc != 0:
-        raise Exception("Disk test verify error!")
+        total_blocks, write_blocks, write_elapsed, _ = figures
+        total_blocks, write_blocks, write_elapsed = int(total_blocks), int(write_blocks), float(write_elapsed)
+
+        # Verify the blocks written, which in the random order are only known
+        # from the same mass and seed as the write
+        args = ['verify', device, str(sect_of_block), str(test_blocks), str(test_time), str(iter_start)]
+        for record in _ResumeDiskDataTest(options + ['-n', str(write_blocks)], args, 'verify'):
+            if record['type'] == 'figures':
+                figures = record['figures']
+            else:
+                yield record
 
-    XenCertPrint("diskdatatest returned : %s" % stdout)
-    lastString = stdout.strip().splitlines()[-1]
-    _, verify_blocks, verify_elapsed, sector_errors = lastString.split()
-    verify_blocks, verify_elapsed, sector_errors = int(verify_blocks), float(verify_elapsed), int(sector_errors)
+        _, verify_blocks, verify_elapsed, sector_errors = figures
+        verify_blocks, verify_elapsed, sector_errors = int(verify_blocks), float(verify_elapsed), int(sector_errors)
 
     if sector_errors != 0:
-        raise Exception("Disk test verify error on %d sectors!", sector_errors)
+        raise Exception("Disk test verify error on %d sectors!" % sector_errors)
         
-    return total_blocks, write_blocks, write_elapsed, verify_blocks, verify_elapsed
+    yield {'type': 'result', 'total_blocks': total_blocks,
+           'write_blocks': write_blocks, 'write_elapsed': write_elapsed,
+           'verify_blocks': verify_blocks, 'verify_elapsed': verify_elapsed}
+
+def DiskDataTestStream(device, test_blocks, sect_of_block=DDT_DEFAULT_BLOCK_SIZE, test_time=0,
+                       queue_depth=DDT_DEFAULT_QUEUE_DEPTH, direct=True, threads=DDT_DEFAULT_THREADS,
+                       pipelined=True, random_seed=None, progress_interval=DDT_PROGRESS_INTERVAL,
+                       coverage=1.0, rate_mbps=0, rate_iops=0):
+    # Run the disk data test and yield its records as they come: a progress
+    # record of each op every progress_interval seconds, a latency record of
+    # each op, a coverage record of a sampled test and a result record at the
+    # end of each order. Every record has the device and the order,
+    # 'sequential' or 'random', set. Closing the generator aborts the test.
+    #
+    # With direct set, diskdatatest bypasses the dom0 page cache and drops the
+    # cached pages between the passes, so the verify pass reads from the array.
+    # With pipelined set, a single writeverify run reads back each window of
+    # blocks while the next one is written, instead of two sequential passes.
+    # With random_seed set, a second run visits the blocks in a random order
+    # seeded by it, so the array prefetch does not hide random IO issues.
+    # With coverage below 1, only a stratified sample of that fraction of the
+    # blocks is tested, spread over the whole device.
+    # With rate_mbps or rate_iops set, the block IOs of both passes together
+    # are held to that many MiB/s or IOPS, to spare the other users of a
+    # shared array.
+    iter_start = random.randint(0, 100000)
+    options = _DiskDataTestOptions(queue_depth, direct, threads, progress_interval, rate_mbps, rate_iops)
+    if coverage < 1:
+        options.extend(['-s', str(coverage)])
+
+    orders = [('sequential', options, iter_start)]
+    if random_seed is not None:
+        # A new iter, so the random run cannot pass on the data of the sequential run
+        orders.append(('random', options + ['-r', str(random_seed)], iter_start + 1))
+
+    for order, order_options, order_iter in orders:
+        for record in _RunDiskDataTest(device, test_blocks, sect_of_block, test_time,
+                                       order_options, order_iter, pipelined):
+            record['device'] = device
+            record['order'] = order
+            yield record
+
+def DiskDataTest(device, test_blocks, sect_of_block=DDT_DEFAULT_BLOCK_SIZE, test_time=0,
+                 queue_depth=DDT_DEFAULT_QUEUE_DEPTH, direct=True, threads=DDT_DEFAULT_THREADS,
+                 pipelined=True, random_seed=None, progress_callback=None, report=None,
+                 coverage=1.0, rate_mbps=0, rate_iops=0):
+    # Run the disk data test and return the figures of the sequential run.
+    # progress_callback is called with each progress record, and aborts the
+    # test by returning False. With a report dict, the latency records of the
+    # sequential run are put into it by op, 'write' and 'verify', and the
+    # coverage record of a sampled run as 'coverage'.
+    result = None
+    for record in DiskDataTestStream(device, test_blocks, sect_of_block, test_time,
+                                     queue_depth, direct, threads, pipelined, random_seed,
+                                     coverage=coverage, rate_mbps=rate_mbps, rate_iops=rate_iops):
+        if record['type'] == 'progress':
+            XenCertPrint("diskdatatest %s %s on %s: %d bytes, %.3f MiB/s, %.1f IOPS, %d errors after %.3f seconds" % \
+                         (record['order'], record['op'], device, record['bytes'], record['mbps'],
+                          record['iops'], record['errors'], record['elapsed']))
+            if progress_callback and progress_callback(record) is False:
+                raise Exception("Disk test aborted on %s!" % device)
+        elif record['type'] == 'latency':
+            XenCertPrint("diskdatatest %s %s latency on %s: %s" % (record['order'], record['op'], device,
+                                                                  FormatDiskDataTestLatency(record)))
+            XenCertPrint("diskdatatest %s %s latency histogram on %s, [low us, high us, IOs]: %s" % \
+                         (record['order'], record['op'], device, record['buckets']))
+            if report is not None and record['order'] == 'sequential':
+                report[record['op']] = record
+        elif record['type'] == 'coverage':
+            XenCertPrint("diskdatatest %s %s coverage on %s: %s" % (record['order'], record['op'], device,
+                                                                   FormatDiskDataTestCoverage(record)))
+            if report is not None and record['order'] == 'sequential':
+                report['coverage'] = record
+        elif record['type'] == 'result':
+            XenCertPrint("%s order wrote %d blocks in %f seconds and verified %d blocks in %f seconds on %s" % \
+                         (record['order'].capitalize(), record['write_blocks'], record['write_elapsed'],
+                          record['verify_blocks'], record['verify_elapsed'], device))
+            if record['order'] == 'sequential':
+                result = (record['total_blocks'], record['write_blocks'], record['write_elapsed'],
+                          record['verify_blocks'], record['verify_elapsed'])
+
+    return result
     
+def DiskDataTestMixed(device, test_blocks, read_percent, sect_of_block=DDT_DEFAULT_BLOCK_SIZE,
+                      test_time=DDT_MIXED_TIME, queue_depth=DDT_DEFAULT_QUEUE_DEPTH, direct=True,
+                      threads=DDT_DEFAULT_THREADS, rate_mbps=0, rate_iops=0):
+    # Write the blocks of the device for up to test_time seconds while
+    # read_percent of the IOs read back and verify blocks already written, so
+    # that reads and writes contend on the array. Return a dict of the write
+    # and read figures, with the latency records by op, 'write' and 'read'.
+    iter_start = random.randint(0, 100000)
+    options = _DiskDataTestOptions(queue_depth, direct, threads, DDT_PROGRESS_INTERVAL, rate_mbps, rate_iops)
+    options.extend(['-m', str(read_percent)])
+    args = ['mixed', device, str(sect_of_block), str(test_blocks), str(test_time), str(iter_start)]
+    result = {}
+    for record in _StreamDiskDataTest([DISKDATATEST] + options + args, 'mixed'):
+        if record['type'] == 'figures':
+            figures = record['figures']
+        elif record['type'] == 'progress':
+            XenCertPrint("diskdatatest mixed %s on %s: %d bytes, %.3f MiB/s, %.1f IOPS, %d errors after %.3f seconds" % \
+                         (record['op'], device, record['bytes'], record['mbps'], record['iops'],
+                          record['errors'], record['elapsed']))
+        elif record['type'] == 'latency':
+            XenCertPrint("diskdatatest mixed %s latency on %s: %s" % (record['op'], device,
+                                                                     FormatDiskDataTestLatency(record)))
+            result[record['op']] = record
+
+    _, write_blocks, elapsed, sector_errors, read_blocks = figures
+    write_blocks, elapsed, sector_errors, read_blocks = int(write_blocks), float(elapsed), int(sector_errors), int(read_blocks)
+    if sector_errors != 0:
+        raise Exception("Disk test read back error on %d sectors!" % sector_errors)
+
+    block_bytes = sect_of_block * DDT_SECTOR_SIZE
+    result['write_blocks'] = write_blocks
+    result['read_blocks'] = read_blocks
+    result['elapsed'] = elapsed
+    result['write_mbps'] = float(write_blocks * block_bytes) / elapsed / MiB
+    result['read_mbps'] = float(read_blocks * block_bytes) / elapsed / MiB
+    XenCertPrint("Mixed test wrote %d blocks and read back %d blocks in %f seconds on %s" % \
+                 (write_blocks, read_blocks, elapsed, device))
+    return result
+
+def DiskDiscardTest(device, test_blocks, sect_of_block=DDT_DEFAULT_BLOCK_SIZE, test_time=0,
+                    threads=DDT_DEFAULT_THREADS, rate_mbps=0, rate_iops=0):
+    # Discard the blocks of the device for up to test_time seconds, which
+    # loses their data, and return a dict of the blocks discarded, the
+    # elapsed time, the discard throughput and the latency record.
+    options = _DiskDataTestOptions(1, False, threads, DDT_PROGRESS_INTERVAL, rate_mbps, rate_iops)
+    args = ['discard', device, str(sect_of_block), str(test_blocks), str(test_time), '0']
+    result = {}
+    for record in _StreamDiskDataTest([DISKDATATEST] + options + args, 'discard'):
+        if record['type'] == 'figures':
+            figures = record['figures']
+        elif record['type'] == 'latency':
+            XenCertPrint("diskdatatest discard latency on %s: %s" % (device, FormatDiskDataTestLatency(record)))
+            result['discard'] = record
+
+    _, blocks, elapsed, _ = figures
+    result['blocks'] = int(blocks)
+    result['elapsed'] = float(elapsed)
+    result['mbps'] = float(result['blocks'] * sect_of_block * DDT_SECTOR_SIZE) / result['elapsed'] / MiB
+    XenCertPrint("Discarded %d blocks of %d sectors in %f seconds on %s" % \
+                 (result['blocks'], sect_of_block, result['elapsed'], device))
+    return result
+
+def FormatDiskDataTestLatency(record):
+    return "%d IOs, p50 %.3f ms, p90 %.3f ms, p99 %.3f ms, p99.9 %.3f ms, max %.3f ms" % \
+           (record['count'], record['p50_us']/1000, record['p90_us']/1000, record['p99_us']/1000,
+            record['p999_us']/1000, record['max_us']/1000)
+
+def FormatDiskDataTestCoverage(record):
+    return "%d of %d blocks (%.3f%%), faults on %.4f%% of the blocks found with 95%% confidence" % \
+           (record['blocks'], record['total_blocks'], record['fraction']*100, record['detect_fraction_95']*100)
+
+def PrintDiskDataTestReport(report):
+    for op in ['write', 'verify']:
+        if report.has_key(op):
+            Print("        %s latency: %s" % (op.capitalize(), FormatDiskDataTestLatency(report[op])))
+    if report.has_key('coverage'):
+        if report['coverage']['blocks'] < report['coverage']['sample_blocks']:
+            Print("        The time budget cut the test short of the %d blocks to test." % report['coverage']['sample_blocks'])
+        Print("        Coverage: %s" % FormatDiskDataTestCoverage(report['coverage']))
+
+def GetDiskDataTestCoverage(estimatedTime, timeBudget):
+    # Fraction of the blocks the disk IO tests can sample to finish within
+    # timeBudget seconds, from the estimated time to test all the blocks
+    if estimatedTime <= timeBudget:
+        return 1.0
+    return max(float(timeBudget)/estimatedTime, DDT_MIN_COVERAGE)
+
+def PlanDiskIOTestRunTime(jobs, maxJobs=DDT_MAX_CONCURRENT_LUNS, maxJobsPerGroup=DDT_MAX_CONCURRENT_LUNS_PER_GROUP):
+    # The seconds the disk IO tests take on the scheduler, from the list of
+    # (groups, estimate) of the LUNs: the longest are started first, at most
+    # maxJobs at once and maxJobsPerGroup through one group, and the others
+    # as soon as one finishes
+    def CanStart(jobGroups):
+        if len(running) >= maxJobs:
+            return False
+        for group in jobGroups:
+            if len([_end for (_end, _groups) in running if group in _groups]) >= maxJobsPerGroup:
+                return False
+        return True
+
+    pending = sorted(jobs, key=lambda job: job[1], reverse=True)
+    # (end, groups) of the tests running
+    running = []
+    now = 0
+    while pending:
+        startable = [job for job in pending if CanStart(job[0])]
+        if startable:
+            pending.remove(startable[0])
+            running.append((now + startable[0][1], startable[0][0]))
+            continue
+        running.sort()
+        (now, _) = running.pop(0)
+    return max([now] + [_end for (_end, _) in running])
+
+def _WriteSmallChunk(device):
+    # First write a small chunk on the device to make sure it works
+    XenCertPrint("First write a small chunk on the device %s to make sure it works." % device)
+    cmd = ['dd', 'if=/dev/zero', 'of=%s' % device, 'bs=1M', 'count=1', 'conv=nocreat', 'oflag=direct']
+    util.pread(cmd)
+
+def _DiskIOTestProgress(progress, device, size, coverage, sect_of_block):
+    # The progress_callback of DiskDataTest which passes the progress records
+    # of the test of the device on to progress, with the bytes the write and
+    # the verify pass come to. The test is registered with progress at once,
+    # so that it is reported stalled even if it hangs before its first record.
+    if progress is None:
+        return None
+    totalBytes = 2 * int(GetBlocksNum(size, sect_of_block) * coverage) * sect_of_block * DDT_SECTOR_SIZE
+    progress(device, totalBytes, {})
+    return lambda record: progress(device, totalBytes, record)
+
+def _DiskIOTestPath(pathNo, device, size, coverage, rate_mbps, rate_iops, sect_of_block, progress, test_time):
+    # Execute a disk IO test against one path to the LUN to verify that it is writeable
+    # and there is no apparent disk corruption
+    PrintOnSameLine("        Path num: %d. Device: %s" % (pathNo, device))
+    try:
+        _WriteSmallChunk(device)
+        
+        XenCertPrint("lun size: %d MB" % size)
+        report = {}
+        try:
+            DiskDataTest(device, GetBlocksNum(size, sect_of_block), sect_of_block, test_time, report=report,
+                         progress_callback=_DiskIOTestProgress(progress, device, size, coverage, sect_of_block),
+                         coverage=coverage, rate_mbps=rate_mbps, rate_iops=rate_iops)
+        finally:
+            if progress:
+                progress(device, 0, None)
+
+        XenCertPrint("Device %s passed the disk IO test. " % device)
+        Print("")
+        displayOperationStatus(True)
+        PrintDiskDataTestReport(report)
+        return True
+        
+    except Exception, e:  
+        Print("        Exception: %s" % str(e))
+        displayOperationStatus(False)
+        XenCertPrint("Device %s failed the disk IO test. Please check if the disk is writable." % device)
+        return False
+
+def _GetTestablePaths(devices):
+    paths = []
+    for device in devices:
+        # If this is a root device then skip IO tests for this device.
+        if os.path.realpath(util.getrootdev()) == device:
+            Print("     -> Skipping IO tests on device %s, as it is the root device." % device)
+            continue
+        paths.append(device)
+    return paths
+
+def DiskIOTestPaths(devices, size, coverage=1.0, rate_mbps=0, rate_iops=0,
+                    sect_of_block=DDT_DEFAULT_BLOCK_SIZE, progress=None, test_time=0):
+    # Execute a disk IO test against all the paths to a LUN at once, each path
+    # writing and verifying its own stripes of the LUN, so that it takes about
+    # the time of a test on one path. If it fails, test the paths one by one to
+    # find the writable ones. Return the number of writable paths. progress
+    # is called with the paths of each test, the bytes it comes to and each
+    # of its progress records, with an empty record when the test starts and
+    # with no record when the test is over.
+    # With test_time, the tests stop after that many seconds in all.
+    paths = _GetTestablePaths(devices)
+
+    if len(paths) > 1:
+        PrintOnSameLine("        Path num: 1-%d. Devices: %s" % (len(paths), ', '.join(paths)))
+        try:
+            for device in paths:
+                _WriteSmallChunk(device)
+
+            XenCertPrint("lun size: %d MB" % size)
+            report = {}
+            device = ','.join(paths)
+            try:
+                DiskDataTest(device, GetBlocksNum(size, sect_of_block), sect_of_block, test_time, report=report,
+                             progress_callback=_DiskIOTestProgress(progress, device, size, coverage, sect_of_block),
+                             coverage=coverage, rate_mbps=rate_mbps, rate_iops=rate_iops)
+            finally:
+                if progress:
+                    progress(device, 0, None)
+
+            XenCertPrint("Devices %s passed the disk IO test. " % paths)
+            Print("")
+            displayOperationStatus(True)
+            PrintDiskDataTestReport(report)
+            return len(paths)
+
+        except Exception, e:
+            Print("        Exception: %s" % str(e))
+            displayOperationStatus(False)
+            XenCertPrint("Devices %s failed the disk IO test, testing the paths one by one." % paths)
+
+    pathPassed = 0
+    if test_time > 0:
+        test_time = max(test_time / max(len(paths), 1), DDT_MIN_TEST_TIME)
+    for pathNo in range(len(paths)):
+        if _DiskIOTestPath(pathNo + 1, paths[pathNo], size, coverage, rate_mbps, rate_iops, sect_of_block,
+                           progress, test_time):
+            pathPassed += 1
+    return pathPassed
+
+def DiskIOTestMixed(devices, size, read_percent, sect_of_block=DDT_DEFAULT_BLOCK_SIZE, rate_mbps=0, rate_iops=0):
+    # Execute a mixed read/write disk IO test against all the paths to a LUN
+    # at once, read_percent of the IOs reading back blocks already written,
+    # and report the read and write figures separately. Return if it passed.
+    paths = _GetTestablePaths(devices)
+    if not paths:
+        return True
+
+    PrintOnSameLine("        Mixed IO, %d%% reads. Devices: %s" % (read_percent, ', '.join(paths)))
+    try:
+        result = DiskDataTestMixed(','.join(paths), GetBlocksNum(size, sect_of_block), read_percent,
+                                   sect_of_block, rate_mbps=rate_mbps, rate_iops=rate_iops)
+    except Exception, e:
+        Print("        Exception: %s" % str(e))
+        displayOperationStatus(False)
+        XenCertPrint("Devices %s failed the mixed read/write IO test." % paths)
+        return False
+
+    Print("")
+    displayOperationStatus(True)
+    for op in ['write', 'read']:
+        Print("        %s: %d blocks, %.1f MiB/s" % (op.capitalize(), result[op + '_blocks'], result[op + '_mbps']))
+        if result.has_key(op):
+            Print("        %s latency: %s" % (op.capitalize(), FormatDiskDataTestLatency(result[op])))
+    return True
+
+def DiskDataTestSweep(devices, size, block_sizes=DDT_SWEEP_BLOCK_SIZES, rate_mbps=0, rate_iops=0,
+                      discard=True):
+    # Run a short disk data test of each block size, in sectors, through all
+    # the paths to a LUN at once, to find the IO size the array handles best.
+    # Return a result dict of each size, with 'error' set on the sizes which
+    # failed, and the size with the highest throughput of both passes, or
+    # None if they all failed. With discard set, the blocks written are then
+    # discarded, and the discard throughput is put in the result as well.
+    paths = _GetTestablePaths(devices)
+    results = []
+    best = None
+    bestMbps = -1
+    for sect_of_block in block_sizes:
+        result = {'sect_of_block': sect_of_block}
+        results.append(result)
+        try:
+            test_blocks = GetBlocksNum(size, sect_of_block)
+            if not paths or test_blocks == 0:
+                raise Exception("No blocks of %d sectors to test" % sect_of_block)
+            report = {}
+            total_blocks, write_blocks, write_elapsed, verify_blocks, verify_elapsed = \
+                    DiskDataTest(','.join(paths), test_blocks, sect_of_block, test_time=DDT_SWEEP_TIME,
+                                 report=report, rate_mbps=rate_mbps, rate_iops=rate_iops)
+        except Exception, e:
+            XenCertPrint("Block size sweep of %d sectors failed on %s: %s" % (sect_of_block, paths, str(e)))
+            result['error'] = str(e)
+            continue
+
+        block_bytes = sect_of_block * DDT_SECTOR_SIZE
+        result['write_mbps'] = float(write_blocks * block_bytes) / write_elapsed / MiB
+        result['verify_mbps'] = float(verify_blocks * block_bytes) / verify_elapsed / MiB
+        # The pipelined verify ends shortly after the write, so verify_elapsed
+        # covers both passes
+        result['mbps'] = float((write_blocks + verify_blocks) * block_bytes) / verify_elapsed / MiB
+        for op in ['write', 'verify']:
+            if report.has_key(op):
+                result[op + '_p50_us'] = report[op]['p50_us']
+                result[op + '_p99_us'] = report[op]['p99_us']
+        if discard:
+            try:
+                result['discard_mbps'] = DiskDiscardTest(','.join(paths), write_blocks, sect_of_block, DDT_SWEEP_TIME,
+                                                         rate_mbps=rate_mbps, rate_iops=rate_iops)['mbps']
+            except Exception, e:
+                XenCertPrint("Discard of %d sectors failed on %s: %s" % (sect_of_block, paths, str(e)))
+        if result['mbps'] > bestMbps:
+            (best, bestMbps) = (sect_of_block, result['mbps'])
+
+    return (results, best)
+
+def PrintDiskDataTestSweep(results):
+    Print("        %-10s  %12s  %12s  %14s  %14s  %13s" % ("Block size", "Write MiB/s", "Verify MiB/s",
+                                                          "Write p50/p99", "Verify p50/p99", "Discard MiB/s"))
+    for result in results:
+        blockSize = "%d KiB" % (result['sect_of_block'] * DDT_SECTOR_SIZE / KiB)
+        if result.has_key('error'):
+            Print("        %-10s  FAILED: %s" % (blockSize, result['error']))
+            continue
+        latency = []
+        for op in ['write', 'verify']:
+            if result.has_key(op + '_p99_us'):
+                latency.append("%.1f/%.1f ms" % (result[op + '_p50_us']/1000, result[op + '_p99_us']/1000))
+            else:
+                latency.append("-")
+        if result.has_key('discard_mbps'):
+            discard = "%.1f" % result['discard_mbps']
+        else:
+            discard = "-"
+        Print("        %-10s  %12.1f  %12.1f  %14s  %14s  %13s" % (blockSize, result['write_mbps'], result['verify_mbps'],
+                                                                 latency[0], latency[1], discard))
+
 def GetBlocksNum(size, sect_of_block=DDT_DEFAULT_BLOCK_SIZE):
     return size*MiB/(sect_of_block*DDT_SECTOR_SIZE)
     
-def FindDiskDataTestEstimate(device, size):
-    # Run diskdatatest in a report mode
+def _BoundDiskDataTestEstimate(total_blocks, block_time, rate_mbps, rate_iops):
+    # The time of a test of total_blocks, at block_time seconds a block. The
+    # short run may have gone faster than the limits on the burst of the
+    # rate limits, but the whole test cannot: both passes share the limits.
+    estimatedTime = total_blocks * block_time
+    if rate_mbps > 0:
+        estimatedTime = max(estimatedTime, 2.0 * total_blocks * DDT_DEFAULT_BLOCK_SIZE * DDT_SECTOR_SIZE / (rate_mbps * MiB))
+    if rate_iops > 0:
+        estimatedTime = max(estimatedTime, 2.0 * total_blocks / rate_iops)
+    return estimatedTime
+
+def _FindDiskDataTestBlockTime(device, size, rate_mbps, rate_iops):
+    # Run diskdatatest in a report mode, and return the seconds a block takes
     XenCertPrint("Run diskdatatest in a report mode with device %s to find the estimated time." % device)
 
     total_blocks, write_blocks, write_elapsed, verify_blocks, verify_elapsed = \
-            DiskDataTest(device, GetBlocksNum(size), test_time=15)
+            DiskDataTest(device, GetBlocksNum(size), test_time=DDT_ESTIMATE_TIME,
+                         rate_mbps=rate_mbps, rate_iops=rate_iops)
+
+    # The pipelined verify finishes shortly after the write, so the verify
+    # rate covers both passes.
+    return verify_elapsed/verify_blocks
 
-    estimatedTime = total_blocks * (write_elapsed/write_blocks + verify_elapsed/verify_blocks)
- 
+def FindDiskDataTestEstimate(device, size, rate_mbps=0, rate_iops=0):
+    block_time = _FindDiskDataTestBlockTime(device, size, rate_mbps, rate_iops)
+    estimatedTime = _BoundDiskDataTestEstimate(GetBlocksNum(size), block_time, rate_mbps, rate_iops)
     XenCertPrint("Total estimated time for testing IO with the device %s as %d" % (device, estimatedTime))
     return estimatedTime
 
+def _GetDeviceModel(device):
+    # The vendor and model of a SCSI disk, from sysfs
+    name = os.path.basename(os.path.realpath(device))
+    model = []
+    for attr in ['vendor', 'model']:
+        try:
+            model.append(util.get_single_entry('/sys/block/%s/device/%s' % (name, attr)).strip())
+        except Exception, e:
+            model.append('')
+    return ' '.join(model).strip()
+
+def _LoadDiskDataTestEstimates(path):
+    try:
+        f = open(path)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except Exception, e:
+        XenCertPrint("No disk data test estimates loaded from %s: %s" % (path, str(e)))
+        return {}
+
+def _SaveDiskDataTestEstimates(path, cache):
+    # Write the cache to a temporary file and rename it over the old one, so
+    # that an interrupted save leaves the old cache as it was
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path))
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except Exception, e:
+        XenCertPrint("Failed to save the disk data test estimates to %s: %s" % (path, str(e)))
+
+class _EstimateWorker(Thread):
+    # Take the LUNs off the queue, and measure the block time of each
+    def __init__(self, queue, rate_mbps, rate_iops, results):
+        Thread.__init__(self)
+        self.queue = queue
+        self.rate_mbps = rate_mbps
+        self.rate_iops = rate_iops
+        self.results = results
+
+    def run(self):
+        while True:
+            try:
+                (scsiid, device, size) = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.results[scsiid] = _FindDiskDataTestBlockTime(device, size, self.rate_mbps, self.rate_iops)
+            except Exception, e:
+                XenCertPrint("Failed to estimate the disk IO test time of SCSI ID %s on %s: %s" % (scsiid, device, str(e)))
+                self.results[scsiid] = e
+
+def FindDiskDataTestEstimates(luns, rate_mbps=0, rate_iops=0, workers=DDT_ESTIMATE_WORKERS,
+                              cache_path=DDT_ESTIMATE_CACHE):
+    # Estimate the time of the disk IO test of each LUN, given as a dict of
+    # SCSI ID -> [(device, size in MiB)] of its paths. All the paths to a LUN
+    # are tested at once, in about the time of one path, so each LUN is only
+    # measured on one path. The seconds a block takes are cached on disk by
+    # SCSI ID, vendor/model, block size and rate limits, and the LUNs not in
+    # the cache are measured up to workers at a time. Return a dict of SCSI
+    # ID -> estimated seconds.
+    cache = _LoadDiskDataTestEstimates(cache_path)
+    now = time.time()
+    keys = {}
+    blockTimes = {}
+    queue = Queue.Queue()
+    for scsiid in luns.keys():
+        paths = _GetTestablePaths([device for (device, _) in luns[scsiid]])
+        if not paths:
+            continue
+        size = luns[scsiid][0][1]
+        keys[scsiid] = "%s|%s|%d|%d|%d" % (scsiid, _GetDeviceModel(paths[0]), DDT_DEFAULT_BLOCK_SIZE,
+                                           rate_mbps, rate_iops)
+        entry = cache.get(keys[scsiid])
+        if entry and now - entry['time'] < DDT_ESTIMATE_CACHE_AGE:
+            XenCertPrint("Reusing the cached disk IO test estimate of SCSI ID %s: %s" % (scsiid, entry))
+            blockTimes[scsiid] = entry['block_time']
+        else:
+            queue.put((scsiid, paths[0], size))
+
+    if not queue.empty():
+        results = {}
+        pool = [_EstimateWorker(queue, rate_mbps, rate_iops, results)
+                for i in range(min(workers, queue.qsize()))]
+        for worker in pool:
+            worker.start()
+        for worker in pool:
+            worker.join()
+
+        for scsiid in results.keys():
+            if isinstance(results[scsiid], Exception):
+                raise Exception("Failed to estimate the disk IO test time of SCSI ID %s: %s" % \
+                                (scsiid, str(results[scsiid])))
+            blockTimes[scsiid] = results[scsiid]
+            cache[keys[scsiid]] = {'block_time': results[scsiid], 'time': now}
+        _SaveDiskDataTestEstimates(cache_path, cache)
+
+    estimates = {}
+    for scsiid in blockTimes.keys():
+        estimates[scsiid] = _BoundDiskDataTestEstimate(GetBlocksNum(luns[scsiid][0][1]), blockTimes[scsiid],
+                                                       rate_mbps, rate_iops)
+        XenCertPrint("Total estimated time for testing IO with SCSI ID %s as %d" % (scsiid, estimates[scsiid]))
+    return estimates
+
+def _ReadDiskStats(devices):
+    # The sectors read and written, the IOs and the milliseconds spent on them
+    # of the devices so far, summed from /proc/diskstats
+    names = set([os.path.basename(os.path.realpath(device)) for device in devices])
+    (sectors, ios, ms) = (0, 0, 0)
+    for line in open('/proc/diskstats'):
+        fields = line.split()
+        if len(fields) < 11 or fields[2] not in names:
+            continue
+        sectors += int(fields[5]) + int(fields[9])
+        ios += int(fields[3]) + int(fields[7])
+        ms += int(fields[6]) + int(fields[10])
+    return (sectors, ios, ms)
+
+class DiskIOTestConcurrency:
+    # Find the number of LUNs to test at once. It starts with one, and adds
+    # one after each interval as long as the throughput of the devices under
+    # test rises by more than gain, and the latency of an IO does not rise to
+    # latency times that of the best number so far. Then it settles on the
+    # best number, and backs off by one whenever the latency, or throughput of
+    # each LUN, is worse than when it settled.
+    def __init__(self, maxLevel=DDT_MAX_CONCURRENT_LUNS, interval=DDT_CONCURRENCY_INTERVAL,
+                 gain=DDT_CONCURRENCY_GAIN, latency=DDT_CONCURRENCY_LATENCY):
+        self.maxLevel = maxLevel
+        self.interval = interval
+        self.gain = gain
+        self.latency = latency
+        self.level = 1
+        self.settled = False
+        # the (level, MiB/s, ms an IO) which is the best so far, or the
+        # baseline once settled
+        self.best = None
+        self.sample = None
+
+    def _Settle(self, level, reason):
+        XenCertPrint("Disk IO test concurrency: %s, settling on %d LUNs at once" % (reason, level))
+        self.settled = True
+        self.level = level
+
+    def _Decide(self, mbps, latency):
+        XenCertPrint("Disk IO test concurrency: %d LUNs at once gave %.1f MiB/s, %.2f ms an IO" % \
+                     (self.level, mbps, latency))
+        if self.best is None:
+            self.best = (self.level, mbps, latency)
+            if not self.settled and self.level < self.maxLevel:
+                self.level += 1
+            elif not self.settled:
+                self._Settle(self.level, "at the most LUNs allowed")
+            return
+
+        (bestLevel, bestMbps, bestLatency) = self.best
+        if not self.settled:
+            if latency > bestLatency * self.latency:
+                self._Settle(bestLevel, "the latency rose from %.2f ms of %d LUNs" % (bestLatency, bestLevel))
+            elif mbps <= bestMbps * (1 + self.gain):
+                self._Settle(bestLevel, "the throughput rose by less than %d%% over %.1f MiB/s of %d LUNs" % \
+                             (self.gain * 100, bestMbps, bestLevel))
+            else:
+                self.best = (self.level, mbps, latency)
+                if self.level < self.maxLevel:
+                    self.level += 1
+                else:
+                    self._Settle(self.level, "at the most LUNs allowed")
+        elif self.level > 1 and (latency > bestLatency * self.latency or mbps < bestMbps * (1 - self.gain)):
+            XenCertPrint("Disk IO test concurrency: degraded from %.1f MiB/s, %.2f ms an IO, backing off to %d LUNs at once" % \
+                         (bestMbps, bestLatency, self.level - 1))
+            self.level -= 1
+            self.best = None
+
+    def Update(self, running, devices):
+        # Called with the number of tests running and their devices, and
+        # return the number of LUNs to test at once. Only the intervals the
+        # same tests ran for, as many as the current number, are measured.
+        now = time.time()
+        key = tuple(sorted(devices))
+        if running != self.level or self.sample is None or self.sample[1] != key:
+            self.sample = (now, key, _ReadDiskStats(devices))
+            return self.level
+        if now - self.sample[0] < self.interval:
+            return self.level
+
+        stats = _ReadDiskStats(devices)
+        (sectors, ios, ms) = [stats[i] - self.sample[2][i] for i in range(3)]
+        elapsed = now - self.sample[0]
+        self.sample = (now, key, stats)
+        if ios > 0:
+            self._Decide(float(sectors) * 512 / MiB / elapsed, float(ms) / ios)
+        return self.level
+
+    def GetLevel(self):
+        # The number of LUNs it settled on, or the best so far
+        if self.settled or self.best is None:
+            return self.level
+        return self.best[0]
+
+def _FormatDuration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%d hours, %d minutes" % (seconds / 3600, seconds % 3600 / 60)
+    if seconds >= 60:
+        return "%d minutes, %d seconds" % (seconds / 60, seconds % 60)
+    return "%d seconds" % seconds
+
+class DiskIOTestProgress:
+    # Gather the progress records of the diskdatatest runs of the LUNs under
+    # test, and print a report of the bytes done, the throughput and the time
+    # left of each run every interval, with the time left of all the tests.
+    # A run which has done no more bytes for DDT_STALL_TIME, whether or not
+    # its records keep coming, is reported stalled, to tell a hung path from
+    # a slow one.
+    def __init__(self, interval=DDT_REPORT_INTERVAL):
+        self.interval = interval
+        self.lock = Lock()
+        # (LUN, device) -> {'total': bytes, 'ops': {op: record}, 'done': bytes,
+        #                   'time': the bytes done last went up, or the run started}
+        self.runs = {}
+        self.lastReport = time.time()
+
+    def Update(self, key, device, totalBytes, record):
+        # The progress callback of the test of the LUN key, see DiskIOTestPaths
+        self.lock.acquire()
+        try:
+            if record is None:
+                self.runs.pop((key, device), None)
+            else:
+                run = self.runs.setdefault((key, device), {'total': totalBytes, 'ops': {}, 'done': 0, 'time': time.time()})
+                if record:
+                    run['ops'][record['op']] = record
+                    done = sum([op['bytes'] for op in run['ops'].values()])
+                    if done > run['done']:
+                        (run['done'], run['time']) = (done, time.time())
+        finally:
+            self.lock.release()
+
+    def Done(self, key):
+        # The test of the LUN key is over
+        self.lock.acquire()
+        for run in [run for run in self.runs.keys() if run[0] == key]:
+            del self.runs[run]
+        self.lock.release()
+
+    def Report(self, doneLUNs, runningLUNs, pendingLUNs, pendingTime, concurrency):
+        # Print the report if it is due, with the numbers of LUNs done, running
+        # and pending, and the estimated seconds of those pending, tested
+        # concurrency at once
+        now = time.time()
+        if now - self.lastReport < self.interval:
+            return
+        self.lastReport = now
+
+        self.lock.acquire()
+        runs = sorted(self.runs.items())
+        self.lock.release()
+        lines = []
+        timeLeft = 0
+        for ((key, device), run) in runs:
+            done = sum([record['bytes'] for record in run['ops'].values()])
+            mbps = sum([record['mbps'] for record in run['ops'].values()])
+            line = "     SCSI ID %s on %s: %s of %d MiB done (%.1f%%), %.1f MiB/s" % \
+                   (key, device, ', '.join(["%s %d MiB" % (op, record['bytes'] / MiB)
+                                            for (op, record) in sorted(run['ops'].items())]) or '0 MiB',
+                    run['total'] / MiB, 100.0 * done / max(run['total'], 1), mbps)
+            if now - run['time'] > DDT_STALL_TIME:
+                line += ", STALLED: no progress for %s" % _FormatDuration(now - run['time'])
+            elif mbps > 0:
+                left = max(run['total'] - done, 0) / (mbps * MiB)
+                timeLeft = max(timeLeft, left)
+                line += ", ETA %s" % _FormatDuration(left)
+            lines.append(line)
+
+        timeLeft += pendingTime / max(concurrency, 1)
+        Print("   PROGRESS at %s: %d LUNs done, %d running, %d pending. Time left about %s." % \
+              (time.strftime("%H:%M:%S"), doneLUNs, runningLUNs, pendingLUNs, _FormatDuration(timeLeft)))
+        for line in lines:
+            Print(line)
+
+class DiskIOTestDeadline:
+    # Split the time left until the deadline across the LUNs still to be
+    # tested. A LUN about to start gets the slots of concurrency LUNs at once
+    # until the deadline, less the time granted to the LUNs running, in
+    # proportion of its estimate to those of all the LUNs not started.
+    def __init__(self, budget):
+        self.deadline = time.time() + budget
+        self.lock = Lock()
+        self.estimates = {}
+        # LUN -> the time its test was granted to end at
+        self.ends = {}
+
+    def Add(self, key, estimate):
+        self.estimates[key] = estimate
+
+    def TestTime(self, key, concurrency, overhead=0):
+        # The seconds the disk IO test of the LUN key may take, less the
+        # overhead seconds of its other tests, at least DDT_MIN_TEST_TIME
+        self.lock.acquire()
+        try:
+            now = time.time()
+            left = self.deadline - now
+            capacity = left * concurrency - sum([max(end - now, 0) for end in self.ends.values()])
+            total = sum(self.estimates.values())
+            estimate = self.estimates.pop(key, 0)
+            if estimate > 0 and total > 0:
+                share = min(left, capacity * estimate / total)
+            else:
+                share = left
+            testTime = int(max(share - overhead, DDT_MIN_TEST_TIME))
+            self.ends[key] = now + testTime + overhead
+        finally:
+            self.lock.release()
+        XenCertPrint("Time budget: %d seconds left, %d LUNs at once, granted %d seconds to the test of %s, estimated %d" % \
+                     (left, concurrency, testTime, key, estimate))
+        return testTime
+
+    def Done(self, key):
+        self.lock.acquire()
+        self.ends.pop(key, None)
+        self.lock.release()
+
+class _DiskIOTestJob(Thread):
+    # The disk IO test of one LUN, run by the scheduler on its own thread.
+    # Its output is kept and printed at once when it is done.
+    def __init__(self, scheduler, key, groups, devices, estimate, func, args):
+        Thread.__init__(self)
+        self.scheduler = scheduler
+        self.key = key
+        self.groups = set(groups)
+        self.devices = devices
+        self.estimate = estimate
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = False
+
+    def run(self):
+        BufferOutput()
+        try:
+            self.result = self.func(*self.args)
+        except Exception, e:
+            XenCertPrint("The disk IO test of %s failed: %s" % (self.key, str(e)))
+            self.error = e
+        FlushOutput()
+        self.scheduler._JobDone(self)
+
+class DiskIOTestScheduler:
+    # Run the disk IO tests of LUNs on a pool of threads, at most maxJobs at
+    # once, and at most maxJobsPerGroup at once through one group, a portal
+    # or an HBA, of the paths to the LUNs. The LUNs with the longest estimates
+    # are started first, so that the short ones fill in the end of the run.
+    # Once a test fails no more are started, as the tests stopped at the
+    # first failure when they ran in series. With a controller, it sets how
+    # many of the maxJobs run at once, and with a progress reporter it prints
+    # its reports while they run.
+    def __init__(self, maxJobs=DDT_MAX_CONCURRENT_LUNS, maxJobsPerGroup=DDT_MAX_CONCURRENT_LUNS_PER_GROUP,
+                 controller=None, progress=None):
+        self.maxJobs = maxJobs
+        self.maxJobsPerGroup = maxJobsPerGroup
+        self.controller = controller
+        self.progress = progress
+        self.concurrency = maxJobs
+        if controller:
+            self.concurrency = min(maxJobs, controller.GetLevel())
+        self.jobs = []
+        self.cond = Condition()
+
+    def Add(self, key, groups, devices, estimate, func, *args):
+        # Schedule func(*args) as the test of the LUN key, whose paths are
+        # the devices and go through the groups
+        self.jobs.append(_DiskIOTestJob(self, key, groups, devices, estimate, func, args))
+
+    def _JobDone(self, job):
+        self.cond.acquire()
+        job.done = True
+        self.cond.notify()
+        self.cond.release()
+
+    def GetConcurrency(self):
+        # The number of tests it runs at once
+        return self.concurrency
+
+    def _CanStart(self, job, running, maxJobs):
+        if len(running) >= maxJobs:
+            return False
+        for group in job.groups:
+            if len([other for other in running if group in other.groups]) >= self.maxJobsPerGroup:
+                return False
+        return True
+
+    def Run(self):
+        # Run the tests, and return the list of (key, result, error) of the
+        # tests which were run, in the order they finished
+        pending = sorted(self.jobs, key=lambda job: job.estimate, reverse=True)
+        running = []
+        finished = []
+        failed = False
+        self.cond.acquire()
+        try:
+            while running or (pending and not failed):
+                maxJobs = self.maxJobs
+                if self.controller:
+                    devices = sum([_job.devices for _job in running], [])
+                    maxJobs = min(maxJobs, self.controller.Update(len(running), devices))
+                self.concurrency = maxJobs
+                if self.progress:
+                    self.progress.Report(len(finished), len(running), len(pending), sum([_job.estimate for _job in pending]), maxJobs)
+                startable = [_job for _job in pending if not failed and self._CanStart(_job, running, maxJobs)]
+                if startable:
+                    job = startable[0]
+                    XenCertPrint("Starting the disk IO test of %s, estimated %d seconds, with %d running" % \
+                                 (job.key, job.estimate, len(running)))
+                    pending.remove(job)
+                    running.append(job)
+                    job.start()
+                    continue
+                # a timeout, so that an interrupt is not held up by the wait
+                self.cond.wait(1)
+                for job in [_job for _job in running if _job.done]:
+                    job.join()
+                    running.remove(job)
+                    if self.progress:
+                        self.progress.Done(job.key)
+                    finished.append((job.key, job.result, job.error))
+                    if job.error is not None:
+                        failed = True
+        finally:
+            self.cond.release()
+        if pending:
+            XenCertPrint("Skipped the disk IO tests of %s after a failure" % [_job.key for _job in pending])
+        return finished
+
 def _find_LUN(svid):
     basepath = "/dev/disk/by-csldev/"
     if svid.startswith("NETAPP_"):
@@ -891,43 +2162,43 @@ def _find_LUN(svid):
         XenCertPrint("DEBUG: device path : %s" % (device))
         return [device]
 
-def WriteDataToVDI(session, vbd_ref, startSec, endSec):
-    XenCertPrint('WriteDataToVDI(vbd_ref=%s, startSec=%s, endSec=%s, ->Enter)' \
-                 % (vbd_ref, startSec, endSec))
+def _PatternSectors(startSec, endSec):
+    # The pattern sectors of the SECTOR_SIZE chunks startSec to endSec
+    return (startSec * SECTOR_SIZE / DiskDataPattern.SECTOR_SIZE,
+            (endSec + 1) * SECTOR_SIZE / DiskDataPattern.SECTOR_SIZE)
+
+def WriteDataToVDI(session, vbd_ref, startSec, endSec, iterStart=0):
+    # Fill the chunks startSec to endSec of the VDI, every sector of them,
+    # with the diskdatatest pattern of iterStart
+    XenCertPrint('WriteDataToVDI(vbd_ref=%s, startSec=%s, endSec=%s, iterStart=%s, ->Enter)' \
+                 % (vbd_ref, startSec, endSec, iterStart))
     try:
         device = os.path.join('/dev/', session.xenapi.VBD.get_device(vbd_ref))
 
         XenCertPrint('about to write onto device: %s' % device)
 
-        with open(device, 'w+') as f:
-            while startSec <= endSec:
-                f.seek(startSec * SECTOR_SIZE)
-                f.write(BUF_PATTERN)
-                startSec += 1
+        (startSect, endSect) = _PatternSectors(startSec, endSec)
+        DiskDataPattern.WritePattern(device, startSect, endSect, iterStart)
     except Exception, e:
         raise Exception('Writing data into VDI:%s Failed. Error: %s' \
                 % (vbd_ref, e))
 
     XenCertPrint('WriteDataToVDI() -> Exit')
 
-def VerifyDataOnVDI(session, vbd_ref, startSec, endSec):
-    XenCertPrint('VerifyDataOnVDI(vdi_ref=%s, startSec=%s, endSec=%s ->Enter)' \
-                 % (vbd_ref, startSec, endSec))
+def VerifyDataOnVDI(session, vbd_ref, startSec, endSec, iterStart=0):
+    # Verify that the chunks startSec to endSec of the VDI, every sector of
+    # them, hold the diskdatatest pattern of iterStart
+    XenCertPrint('VerifyDataOnVDI(vdi_ref=%s, startSec=%s, endSec=%s, iterStart=%s ->Enter)' \
+                 % (vbd_ref, startSec, endSec, iterStart))
     try:
         device = os.path.join('/dev/', session.xenapi.VBD.get_device(vbd_ref))
 
         XenCertPrint('about to read from device: %s' % device)
 
-        expect = BUF_PATTERN
-
-        with open(device, 'r+') as f:
-            while startSec <= endSec:
-                f.seek(startSec * SECTOR_SIZE)
-                actual = f.read(len(expect))
-                if actual != expect:
-                    raise Exception('expected:%s != actual:%s'\
-                             % (expect, actual))
-                startSec += 1
+        (startSect, endSect) = _PatternSectors(startSec, endSec)
+        errors = DiskDataPattern.VerifyPattern(device, startSect, endSect, iterStart)
+        if errors != 0:
+            raise Exception('%d sectors do not hold the expected pattern' % errors)
     except Exception, e:
         raise Exception('Verification of data in VDI:%s Failed. Error:%s'\
                 % (vbd_ref, e))
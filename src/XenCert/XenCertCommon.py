@@ -72,7 +72,21 @@ __commonparams__ = [
     ["pathInfo", "pass-through string used to pass data to the callout utility above, for e.g. login credentials etc. This string is passed as-is to the callout utility. ",
                                                                                     " : ", None, "optional", "-i", ""],
     ["count", "count of iterations to perform in case of multipathing failover testing",
-                                                                                    " : ", None, "optional", "-g", ""]]
+                                                                                    " : ", None, "optional", "-g", ""],
+    ["mpLUNs", "number of LUNs to fail over at once in case of multipathing failover testing, each on its own SR with IO running on it. One by default",
+                                                                                    " : ", None, "optional", "-N", ""]]
+
+__functionalparams__ = [
+    ["rateMBps", "limit the disk IO tests to this many MiB/s, to spare the other users of an array already in use",
+                                                                                    " : ", None, "optional", "-B", ""],
+    ["rateIOPS", "limit the disk IO tests to this many IOs per second, to spare the other users of an array already in use",
+                                                                                    " : ", None, "optional", "-I", ""],
+    ["blockSizes", "comma separated list of block sizes in KiB, e.g. 4,8,64,256,1024,4096, to benchmark on each LUN before its disk IO tests, which then use the size with the highest throughput",
+                                                                                    " : ", None, "optional", "-z", ""],
+    ["readPercent", "percentage of reads, 0 to 99, of a mixed read/write disk IO test run on each LUN after its disk IO tests, which reads back blocks already written while writing the others. Not run by default",
+                                                                                    " : ", None, "optional", "-P", ""],
+    ["concurrentLUNs", "number of LUNs to run the disk IO tests on at once. By default it starts with one and adds more while the total throughput keeps rising",
+                                                                                    " : ", None, "optional", "-L", ""]]
 
 def parse_args(version_string):
     """Parses the command line arguments"""
@@ -116,6 +130,12 @@ def parse_args(version_string):
                        default=element[3],
                        help=element[1],
                        dest=element[0])
+
+    for element in __functionalparams__:
+        opt.add_option(element[5], element[6],
+                       default=element[3],
+                       help=element[1],
+                       dest=element[0])
     
     for element in __common__:
         opt.add_option(element[5], element[6],
@@ -150,6 +170,36 @@ def valid_arguments(options, g_storage_conf):
             else:
                 g_storage_conf[element[0]] = "" 
         value = getattr(options, element[0])
+        if element[0] == "mpLUNs" and value:
+            try:
+                valid = int(value) > 0
+            except ValueError:
+                valid = False
+            if not valid:
+                Print("Error: %s argument (%s: %s) has an invalid value %s" \
+                       % (element[4], element[5], element[1], value))
+                return 0
+        g_storage_conf[element[0]] = value
+
+    for element in __functionalparams__:
+        value = getattr(options, element[0])
+        if value:
+            try:
+                if element[0] == "blockSizes":
+                    valid = min([int(size) for size in value.split(',')]) > 0
+                elif element[0] == "readPercent":
+                    # all reads would never end the writes
+                    valid = 0 <= int(value) < 100
+                elif element[0] == "concurrentLUNs":
+                    valid = int(value) > 0
+                else:
+                    valid = float(value) > 0
+            except ValueError:
+                valid = False
+            if not valid:
+                Print("Error: %s argument (%s: %s) has an invalid value %s" \
+                       % (element[4], element[5], element[1], value))
+                return 0
         g_storage_conf[element[0]] = value
 
     if options.storage_type == "nfs":
@@ -214,6 +264,9 @@ def DisplayTestSpecificOptions():
     Print("Multipathing test options (-m above):\n")
     for item in __commonparams__:
         printHelpItem(item)
+    Print("\nFunctional test options (-f above):\n")
+    for item in __functionalparams__:
+        printHelpItem(item)
 
 def DisplayStorageSpecificUsage(storage_type):
     if storage_type == 'iscsi':
@@ -1,6 +1,7 @@
 import commands
 import os
 import sys
+import threading
 from util import SMlog
 
 
@@ -16,20 +17,21 @@ def PrintToLog(message):
     except:
         pass
 
+# Output of the threads which buffer it, to be printed at once when they are done
+_output = threading.local()
+_outputLock = threading.Lock()
+
 def Print(message):
     # Print to the stdout and to a temp file.
-    try:
-        sys.stdout.write(message)
-        sys.stdout.write('\n')
-        global logfile
-        logfile.write(message)
-        logfile.write('\n')
-        logfile.flush()
-    except:
-        pass
+    PrintOnSameLine(message + '\n')
 
 def PrintOnSameLine(message):
-    # Print to the stdout and to a temp file.
+    # Print to the stdout and to a temp file, or to the buffer of the thread.
+    buffer = getattr(_output, 'buffer', None)
+    if buffer is not None:
+        buffer.append(message)
+        return
+    _outputLock.acquire()
     try:
         sys.stdout.write(message)
         global logfile
@@ -37,6 +39,19 @@ def PrintOnSameLine(message):
         logfile.flush()
     except:
         pass
+    _outputLock.release()
+
+def BufferOutput():
+    # Keep the output of this thread until FlushOutput, so that the output of
+    # threads running at the same time does not interleave.
+    _output.buffer = []
+
+def FlushOutput():
+    # Print the output kept by this thread, and stop keeping it.
+    buffer = getattr(_output, 'buffer', None)
+    _output.buffer = None
+    if buffer:
+        PrintOnSameLine(''.join(buffer))
 
 def InitLogging():
     global logfile
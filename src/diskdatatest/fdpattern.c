@@ -16,6 +16,7 @@
   #define _GNU_SOURCE
 #endif
 #include <stdbool.h>
+#include <stdint.h>
 #include <errno.h>
 #include <fcntl.h>
 #include <stdio.h>
@@ -26,7 +27,12 @@
 #include <linux/fs.h>
 #include <string.h>
 #include <time.h>
+#include <limits.h>
+#include <math.h>
+#include <pthread.h>
+#include <sys/time.h>
 #include "atomicio.h"
+#include "kaio.h"
 
 /* This tool is able to write test pattern to disk and verify it.
  * One sector, 512 bytes, is split to mutiple slices. And there 
@@ -45,6 +51,7 @@ struct fd_state {
     unsigned long long size;        // device size in sectors
     unsigned long long size_sects;  // total sectors
     unsigned long long fullsize;    // full size of the device
+    bool               block_dev;   // the device is a block device, not a file
 };
 
 struct sector_slice {
@@ -55,25 +62,195 @@ struct sector_slice {
 #define DEFAULT_SECTOR_SIZE 512
 #define SECTOR_SHIFT 9
 #define HEADERS_OF_SECTION (DEFAULT_SECTOR_SIZE / sizeof(struct sector_slice))
+#define LOG_SECTS (512*1024*1024/DEFAULT_SECTOR_SIZE) // logging per 512MB
+
+#define DEFAULT_QUEUE_DEPTH 1
+#define MAX_QUEUE_DEPTH 1024
+#define MAX_THREADS 256
+#define MAX_DEVICES 64
+#define DEFAULT_WINDOW 64
+#define FEISTEL_ROUNDS 4
+#define CHECKPOINT_INTERVAL 10
+#define BUF_ALIGN 4096
+#define EXIT_IO_ERROR 2     // exit status of a failed block IO, e.g. on a path blip: the op can be resumed
+#define THROTTLE_BURST 0.1  // seconds of the rate limits which may be used at once
+
+/* Latency histogram: log-linear buckets of IO time in ns, LAT_SUB linear
+ * buckets per power of 2, so a bucket is within 1/LAT_SUB of its values.
+ */
+#define LAT_SUB_BITS 4
+#define LAT_SUB      (1 << LAT_SUB_BITS)
+#define LAT_BUCKETS  ((64 - LAT_SUB_BITS + 1) * LAT_SUB)
+
+#define OP_WRITE       0
+#define OP_VERIFY      1
+#define OP_WRITEVERIFY 2
+#define OP_MIXED       3
+#define OP_DISCARD     4
+
+#define DEFAULT_READ_PERCENT 50
+
+#define GATE_CLOSED  -1    // the writer will not write the block
+#define GATE_PENDING  0    // the writer has not written the block yet
+#define GATE_OPEN     1    // the block is written and can be verified
+
+/* Token bucket of a rate limit, refilled at rate tokens per second up to
+ * burst tokens.
+ */
+struct bucket {
+    double             rate;
+    double             burst;
+    double             tokens;
+};
+
+struct histogram {
+    unsigned long long count;
+    unsigned long long min;
+    unsigned long long max;
+    unsigned long long buckets[LAT_BUCKETS];
+};
+
+/* Each worker owns one interleaved stripe of the blocks:
+ * id, id + threads, id + 2 * threads, ...
+ * In writeverify each stripe has a writer and a verifier, and the verifier
+ * reads back each window of the stripe once the writer has written it.
+ */
+struct worker {
+    pthread_t          thread;
+    unsigned long      id;
+    int                fd;
+    unsigned long      dev;         // index of the device the worker ops
+    bool               op_write;
+    char               *buf;        // buffers of queue_depth blocks to write/read
+    char               *expect;     // expected block, to verify a read block
+    unsigned long long done;        // blocks [0, done) of the stripe are op-ed
+    unsigned long long ios;         // block IOs completed, for the progress
+    struct histogram   lat;         // latency of the block IOs
+    unsigned long long reads;       // read back IOs completed in the mixed op
+    struct histogram   read_lat;    // latency of the read back IOs in the mixed op
+    unsigned long long rng;         // counter of the read/write choices in the mixed op
+    double             elapsed;     // time the worker took
+    int                ret;
+
+    struct worker      *gate;       // writer of the stripe, for a verifier in writeverify
+    unsigned long long published;   // blocks of the stripe the verifier may read
+    bool               finished;    // the writer will publish no more blocks
+    pthread_mutex_t    lock;
+    pthread_cond_t     cond;
+};
 
 unsigned long long sects_of_block = 0;  // input: sector count of one block
 unsigned long long max_blocks = 0;      // input: max blocks to write/read
+unsigned long long op_count = 0;        // input: blocks to op in the sequence, all of the sequence by default
+double sample_fraction = 1;             // input: fraction of the blocks in the sample
+unsigned long long seq_blocks = 0;      // blocks in the sequence, the sample of max_blocks
 unsigned long long max_time = 0;        // input: max time to test, in second
 unsigned long long total_sects = 0;     // total secters
 unsigned long long block_size = 0;      // block size in bytes
-char *block_buf = NULL;                 // buffer of one block to each write/read
+unsigned long queue_depth = DEFAULT_QUEUE_DEPTH; // input: IOs kept in flight
+bool direct_io = false;                 // input: bypass the dom0 page cache
+unsigned long threads = 1;              // input: number of striped workers
+unsigned long long window = DEFAULT_WINDOW; // input: blocks per stripe verified at once in writeverify
+int op = OP_WRITE;                      // input: op to test
+bool random_order = false;              // input: op the blocks in a seeded random order
+unsigned long long read_percent = DEFAULT_READ_PERCENT; // input: percentage of reads in the mixed op
+unsigned long long seed = 0;            // input: seed of the random order
+unsigned int half_bits = 0;             // half width of the random order permutation
+unsigned long nworkers = 0;             // workers, two per stripe in writeverify
+struct worker *workers = NULL;          // the workers
 struct fd_state state = {0};            // device size info
+struct timeval start_time;              // start time of the op
+volatile bool stop = false;             // time is up, tells the workers to stop
+volatile bool failed = false;           // a worker failed, tells all the workers to stop
+double progress_interval = 0;           // input: seconds between progress records, 0 for none
+const char *checkpoint_file = NULL;     // input: file to save the progress of the op in
+bool resume = false;                    // input: resume the op saved in checkpoint_file
+const char *device = NULL;              // input: device files, separated by ','
+char *devices[MAX_DEVICES];             // the device files, paths to the same LUN
+unsigned long ndevices = 0;             // number of device files
+unsigned long long resume_blocks = 0;   // blocks [0, resume_blocks) of the order op-ed before resume
+double resume_elapsed = 0;              // elapsed time of the op before resume
+bool progress_done = false;             // tells the progress reporter to exit
+pthread_mutex_t progress_lock = PTHREAD_MUTEX_INITIALIZER;
+pthread_cond_t progress_cond = PTHREAD_COND_INITIALIZER;
+double rate_mbps = 0;                   // input: max MiB/s of all the block IOs, 0 for no limit
+double rate_iops = 0;                   // input: max IOPS of all the block IOs, 0 for no limit
+struct bucket bytes_bucket = {0};       // rate_mbps limit, in bytes
+struct bucket ios_bucket = {0};         // rate_iops limit, in block IOs
+unsigned long long throttle_ns = 0;     // time the buckets were last refilled
+pthread_mutex_t throttle_lock = PTHREAD_MUTEX_INITIALIZER;
 
-unsigned long long sect = 0;            // current sector in writing/reading
-unsigned long long iter = 0;            // input: current iterater for sector_slice(s)
+unsigned long long iter_start = 0;      // input: initial iterater for sector_slice(s)
 unsigned long long sect_errors = 0;     // total verify errors of sectors
 
 
 void usage(const char *cmd)
 {
-    fprintf(stderr, "usage: %s <op> <device> <block> <mass> <time> <iter>\n"
-            "  op:     'write' or 'verify' test\n"
-            "  device: device file\n"
+    fprintf(stderr, "usage: %s [-q depth] [-d] [-t threads] [-w window] [-r seed] [-n count] [-p interval]\n"
+            "       [-s fraction] [-c checkpoint [-R]] [-b mbps] [-i iops]\n"
+            "       [-m percent]\n"
+            "       <op> <device> <block> <mass> <time> <iter>\n"
+            "  -q depth:   number of block IOs kept in flight with Linux native AIO,\n"
+            "              1 (default) means synchronous IO, one block at a time\n"
+            "  -d:         direct IO, open the device with O_DIRECT, and flush and\n"
+            "              invalidate its cached pages after write and before verify\n"
+            "  -t threads: number of workers, each with its own fd and buffers, which\n"
+            "              op the blocks in interleaved stripes, 1 by default. With -q\n"
+            "              every worker keeps <depth> IOs in flight\n"
+            "  -w window:  blocks of each stripe written ahead of the verify in\n"
+            "              writeverify, %d by default\n"
+            "  -r seed:    op the blocks in a random order, a permutation of the\n"
+            "              <mass> blocks seeded by <seed>. Verify with the same\n"
+            "              <mass>, <seed> and <fraction> as the write\n"
+            "  -n count:   op only the first <count> blocks of the order, <mass> by\n"
+            "              default. Verify a random write which ran out of time\n"
+            "              with <count> set to its op_blocks\n"
+            "  -p interval: print a JSON progress record of each op every <interval>\n"
+            "              seconds, for example:\n"
+            "              {\"type\": \"progress\", \"op\": \"write\", \"elapsed\": 10.000,\n"
+            "               \"bytes\": 1560281088, \"mbps\": 148.750, \"iops\": 595.0,\n"
+            "               \"errors\": 0}\n"
+            "              mbps and iops are for the last interval, in MiB/s\n"
+            "  -s fraction: op a stratified sample of the blocks, one block at a\n"
+            "              random offset, set by <iter>, in each of the strata the\n"
+            "              <mass> blocks are evenly split into. The other options\n"
+            "              work on the sample, and a JSON coverage record is printed\n"
+            "              before the final numbers, which count the sampled blocks.\n"
+            "              It is printed as well when <time> cuts the op short\n"
+            "  -c checkpoint: save the progress of the op in file <checkpoint> every\n"
+            "              <interval> or %d seconds, and when the op ends\n"
+            "  -R:         resume the op saved in <checkpoint> from its first block\n"
+            "              not op-ed, with the same arguments but for -q, -t, -w,\n"
+            "              -p, -b and -i. op_blocks, op_elapsed and sect_errors count\n"
+            "              the op from its start\n"
+            "  -b mbps:    limit the block IOs of all the workers, write and verify\n"
+            "              together, to <mbps> MiB/s, to share the array with other\n"
+            "              hosts. No limit by default\n"
+            "  -i iops:    limit the block IOs of all the workers to <iops> IOs per\n"
+            "              second. No limit by default\n"
+            "  -m percent: percentage of the IOs of the mixed op which read back\n"
+            "              a block, from 0 to 99, %d by default\n"
+            "\n"
+            "before the final numbers, print a JSON latency record of each op with\n"
+            "the percentiles and the histogram of the block IO times, for example:\n"
+            "  {\"type\": \"latency\", \"op\": \"write\", \"count\": 5989, \"min_us\": 402.000,\n"
+            "   \"p50_us\": 2431.000, \"p90_us\": 3071.000, \"p99_us\": 5119.000,\n"
+            "   \"p999_us\": 12287.000, \"max_us\": 14316.227,\n"
+            "   \"buckets\": [[low_us, high_us, count], ...]}\n"
+            "\n"
+            "  op:     'write' or 'verify' test, or 'writeverify' to verify each\n"
+            "          window of blocks while the next window is being written, or\n"
+            "          'mixed' to write the blocks while reading back and verifying\n"
+            "          blocks already written, at random, by <percent> of the IOs,\n"
+            "          or 'discard' to discard the blocks with BLKDISCARD, or by\n"
+            "          punching holes in a file. discard is synchronous, -q is\n"
+            "          ignored, and its records are of op 'discard'\n"
+            "  device: device file, or the device files of all the paths to one LUN\n"
+            "          separated by ','. The stripes are spread over the paths, at\n"
+            "          least one for each, and in writeverify each stripe is\n"
+            "          verified through the next path to the one it was written\n"
+            "          through. A JSON device record of each path is printed\n"
+            "          before the final numbers\n"
             "  block:  number of sectors for one block, greater than 0. Note: one sector size is 512 bytes\n"
             "  mass:   max number of blocks for test, greater than 0\n"
             "  time:   max elapsed time to test, in seconds, 0 means unlimit\n"
@@ -81,9 +258,20 @@ void usage(const char *cmd)
             "\n"
             "return 0 when op executed successfully and output numbers:\n"
             "  max_blocks:  same to input <block>\n"
-            "  op_blocks:   total number of blocks op-ed in practice\n"
+            "  op_blocks:   total number of blocks op-ed in practice, the first\n"
+            "               op_blocks blocks of the order are all op-ed\n"
             "  op_elapsed:  total elapsed time in practice\n"
             "  sect_errors: number of sectors with verify error\n"
+            "writeverify outputs op_blocks and op_elapsed of the write, followed by:\n"
+            "  verify_blocks:  total number of blocks verified in practice\n"
+            "  verify_elapsed: elapsed time until the last block was verified\n"
+            "mixed outputs op_blocks and op_elapsed of the write, and sect_errors of\n"
+            "the reads, followed by:\n"
+            "  read_ios:    total number of blocks read back\n"
+            "and its JSON progress and latency records are of op 'write' and 'read'\n"
+            "\n"
+            "return %d when a block IO failed, so that the op can be resumed with -R,\n"
+            "and 1 on any other failure\n"
             "\n"
             "examples:\n"
             "  # diskdatatest write /dev/sdb 512 1228956 15 1000\n"
@@ -94,27 +282,189 @@ void usage(const char *cmd)
             "  # diskdatatest write /dev/sdb 512 1228956 0 2000\n"
             "  1228956 1228956 3109.534673 0\n"
             "  # diskdatatest verify /dev/sdb 512 1228956 0 2000\n"
-            "  1228956 1228956 2462.567301 0\n",
-            cmd);
+            "  1228956 1228956 2462.567301 0\n"
+            "\n"
+            "  # diskdatatest -q 32 -d write /dev/sdb 512 1228956 0 3000\n"
+            "  1228956 1228956 1021.340581 0\n"
+            "  # diskdatatest -q 32 -d verify /dev/sdb 512 1228956 0 3000\n"
+            "  1228956 1228956 1187.092215 0\n"
+            "\n"
+            "  # diskdatatest -t 4 -q 8 -d write /dev/sdb 512 1228956 0 4000\n"
+            "  1228956 1228956 402.771630 0\n"
+            "\n"
+            "  # diskdatatest -t 4 -q 8 -d writeverify /dev/sdb 512 1228956 0 5000\n"
+            "  1228956 1228956 431.026518 0 1228956 431.395003\n"
+            "\n"
+            "  # diskdatatest -t 4 -q 8 -d -r 42 write /dev/sdb 512 1228956 15 6000\n"
+            "  1228956 20744 15.000417 0\n"
+            "  # diskdatatest -t 4 -q 8 -d -r 42 -n 20744 verify /dev/sdb 512 1228956 15 6000\n"
+            "  1228956 20744 11.371862 0\n"
+            "\n"
+            "  # diskdatatest -t 4 -q 8 -d -b 50 -i 400 write /dev/sdb 512 1228956 15 7000\n"
+            "  1228956 3000 15.000611 0\n"
+            "\n"
+            "  # diskdatatest -t 4 -q 8 -d -m 30 mixed /dev/sdb 512 1228956 60 8000\n"
+            "  1228956 52311 60.000874 0 22419\n"
+            "\n"
+            "  # diskdatatest -t 4 discard /dev/sdb 2048 307239 15 0\n"
+            "  307239 307239 9.481310 0\n",
+            cmd, DEFAULT_WINDOW, CHECKPOINT_INTERVAL, DEFAULT_READ_PERCENT, EXIT_IO_ERROR);
 }
 
-void init_params(int argc, char *argv[])
+/* A full bucket, which holds at least the tokens of one block IO */
+void init_bucket(struct bucket *b, double rate, double cost)
 {
-    if (argc != 7) {
+    b->rate = rate;
+    b->burst = rate * THROTTLE_BURST;
+    if (b->burst < cost)
+        b->burst = cost;
+    b->tokens = b->burst;
+}
+
+/* Parse the options, and return the index of the first positional argument */
+int init_params(int argc, char *argv[])
+{
+    int opt;
+    char **args, *path;
+
+    while ((opt = getopt(argc, argv, "q:dt:w:r:n:p:s:c:Rb:i:m:")) != -1) {
+        switch (opt) {
+        case 'q':
+            queue_depth = strtoul(optarg, NULL, 10);
+            if (queue_depth < 1 || queue_depth > MAX_QUEUE_DEPTH) {
+                fprintf(stderr, "<depth> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'd':
+            direct_io = true;
+            break;
+        case 't':
+            threads = strtoul(optarg, NULL, 10);
+            if (threads < 1 || threads > MAX_THREADS) {
+                fprintf(stderr, "<threads> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'w':
+            window = strtoull(optarg, NULL, 10);
+            if (window < 1) {
+                fprintf(stderr, "<window> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'r':
+            random_order = true;
+            seed = strtoull(optarg, NULL, 10);
+            break;
+        case 'n':
+            op_count = strtoull(optarg, NULL, 10);
+            if (op_count < 1) {
+                fprintf(stderr, "<count> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'p':
+            progress_interval = strtod(optarg, NULL);
+            if (progress_interval <= 0) {
+                fprintf(stderr, "<interval> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 's':
+            sample_fraction = strtod(optarg, NULL);
+            if (sample_fraction <= 0 || sample_fraction > 1) {
+                fprintf(stderr, "<fraction> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'c':
+            checkpoint_file = optarg;
+            break;
+        case 'R':
+            resume = true;
+            break;
+        case 'b':
+            rate_mbps = strtod(optarg, NULL);
+            if (rate_mbps <= 0) {
+                fprintf(stderr, "<mbps> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'i':
+            rate_iops = strtod(optarg, NULL);
+            if (rate_iops <= 0) {
+                fprintf(stderr, "<iops> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'm':
+            read_percent = strtoull(optarg, NULL, 10);
+            if (read_percent > 99) {
+                fprintf(stderr, "<percent> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        default:
+            usage(argv[0]);
+            exit(1);
+        }
+    }
+
+    if (argc - optind != 6) {
         fprintf(stderr, "Parameter count is incorrect\n");
         usage(argv[0]);
         exit(1);
     }
-    if (strcmp(argv[1], "write") && strcmp(argv[1], "verify")) {
+    if (resume && !checkpoint_file) {
+        fprintf(stderr, "-R needs <checkpoint>\n");
+        usage(argv[0]);
+        exit(1);
+    }
+    args = argv + optind;
+    if (!strcmp(args[0], "write")) {
+        op = OP_WRITE;
+    } else if (!strcmp(args[0], "verify")) {
+        op = OP_VERIFY;
+    } else if (!strcmp(args[0], "writeverify")) {
+        op = OP_WRITEVERIFY;
+    } else if (!strcmp(args[0], "mixed")) {
+        op = OP_MIXED;
+    } else if (!strcmp(args[0], "discard")) {
+        op = OP_DISCARD;
+    } else {
         fprintf(stderr, "Unknown <op>\n");
         usage(argv[0]);
         exit(1);
     }
     
-    sects_of_block  = strtoull(argv[3], NULL, 10);
-    max_blocks      = strtoull(argv[4], NULL, 10);
-    max_time        = strtoull(argv[5], NULL, 10);
-    iter            = strtoull(argv[6], NULL, 10);
+    device          = args[1];
+    for (path = strtok(strdup(device), ","); path; path = strtok(NULL, ",")) {
+        if (ndevices == MAX_DEVICES) {
+            fprintf(stderr, "More than %d devices\n", MAX_DEVICES);
+            usage(argv[0]);
+            exit(1);
+        }
+        devices[ndevices++] = path;
+    }
+    if (ndevices == 0) {
+        fprintf(stderr, "<device> is incorrect\n");
+        usage(argv[0]);
+        exit(1);
+    }
+    sects_of_block  = strtoull(args[2], NULL, 10);
+    max_blocks      = strtoull(args[3], NULL, 10);
+    max_time        = strtoull(args[4], NULL, 10);
+    iter_start      = strtoull(args[5], NULL, 10);
     if (sects_of_block < 1) {
         fprintf(stderr, "<block> is incorrect\n");
         usage(argv[0]);
@@ -126,53 +476,77 @@ void init_params(int argc, char *argv[])
         exit(1);
     }
     
+    seq_blocks = ceil(sample_fraction * max_blocks);
+    if (seq_blocks < 1 || seq_blocks > max_blocks)
+        seq_blocks = max_blocks;
+    if (op_count == 0 || op_count > seq_blocks)
+        op_count = seq_blocks;
+    
     block_size = sects_of_block * DEFAULT_SECTOR_SIZE;
     total_sects = max_blocks * sects_of_block;
+    while ((1ULL << (2 * half_bits)) < seq_blocks)
+        half_bits++;
+    if (threads < ndevices)
+        threads = ndevices;
+    if (threads > op_count)
+        threads = op_count;
+    if (op == OP_DISCARD)
+        queue_depth = 1;    // there is no AIO discard
+    if (queue_depth > (op_count + threads - 1) / threads)
+        queue_depth = (op_count + threads - 1) / threads;
+    nworkers = op == OP_WRITEVERIFY ? 2 * threads : threads;
+    if (rate_mbps > 0)
+        init_bucket(&bytes_bucket, rate_mbps * 1024 * 1024, block_size);
+    if (rate_iops > 0)
+        init_bucket(&ios_bucket, rate_iops, 1);
+
+    return optind;
 }
 
-void alloc_block_buf()
+/* The pattern only depends on the block number, so blocks can be
+ * written and verified in any order, and by any number of IOs in flight.
+ */
+static inline unsigned long long block_iter(unsigned long long blk)
 {
-    block_buf = malloc(block_size);
-    if (!block_buf) 
-    {
-        fprintf(stderr, "Malloc block buffer failed\n");
-        exit(1);
-    }
+    return iter_start + blk * sects_of_block * HEADERS_OF_SECTION;
 }
 
-void free_block_buf()
+/* Build the pattern of a block, as plain stores of 64-bit words which
+ * the compiler is free to vectorize.
+ */
+static inline void fill_block(char *buf, unsigned long long blk)
 {
-    if (block_buf)
-        free(block_buf);
-    block_buf = NULL;
+    unsigned long long *word = (unsigned long long *)buf;
+    unsigned long long sect = blk * sects_of_block;
+    unsigned long long iter = block_iter(blk);
+    unsigned long long i = 0, j;
+    for (; i < sects_of_block; i++) {
+        for (j = 0; j < HEADERS_OF_SECTION; j++) {
+            word[2*j] = sect;
+            word[2*j + 1] = iter + j;
+        }
+        word += 2 * HEADERS_OF_SECTION;
+        iter += HEADERS_OF_SECTION;
+        sect++;
+    }
 }
 
-inline void update_sect(char *sect_buf)
+static inline void log_block(const char *what, unsigned long long blk)
 {
-    struct sector_slice *hdr = NULL;
-    unsigned long long i = 0;
-    for (; i < HEADERS_OF_SECTION; i++) {
-        hdr = (struct sector_slice *)sect_buf + i;
-        hdr->sect = sect;
-        hdr->iter = iter++;
-    }
+    unsigned long long sect = blk * sects_of_block;
+    unsigned long long end = sect + sects_of_block;
+    for (sect = (sect + LOG_SECTS - 1) / LOG_SECTS * LOG_SECTS; sect < end; sect += LOG_SECTS)
+        printf("%s sector %llx of %llx\n", what, sect, total_sects);
 }
 
-inline void update_block()
+static inline void update_block(char *buf, unsigned long long blk)
 {
-    unsigned long long i = 0;
-    for (; i < sects_of_block; i++) {
-        update_sect(block_buf + i*DEFAULT_SECTOR_SIZE);
-        
-        if (!(sect % (512*1024*1024/DEFAULT_SECTOR_SIZE))) // logging per 512MB
-        {
-            printf("Writing sector %llx of %llx\n", sect, total_sects);
-        }
-        sect++;
-    }
+    fill_block(buf, blk);
+    log_block("Writing", blk);
 }
 
-inline void verify_sect(const char *sect_buf)
+static inline void verify_sect(const char *sect_buf, unsigned long long sect,
+                               unsigned long long *iter)
 {
     const struct sector_slice *hdr = NULL;
     bool sect_error = false;
@@ -185,31 +559,36 @@ inline void verify_sect(const char *sect_buf)
                 fprintf(stderr, "Unmatched sector %llu for %llu:\n", hdr->sect, sect);
             }
         }
-        if (hdr->iter != iter) {
+        if (hdr->iter != *iter) {
             sect_error = true;
             if (sect_errors < 5) {     // only logging first 5 details
-                fprintf(stderr, "Unmatched iter %llu for %llu:\n", hdr->iter, iter);
+                fprintf(stderr, "Unmatched iter %llu for %llu:\n", hdr->iter, *iter);
             }
         }
-        iter++;
+        (*iter)++;
     }
     
     if (sect_error)
-        sect_errors++;
+        __sync_fetch_and_add(&sect_errors, 1);
 }
 
-inline void verify_block()
+/* Compare the block with the expected pattern built in expect, and only
+ * walk the slices of the sectors to report the errors on a mismatch.
+ */
+static inline void verify_block(const char *buf, char *expect, unsigned long long blk)
 {
+    unsigned long long sect = blk * sects_of_block;
+    unsigned long long iter = block_iter(blk);
     unsigned long long i = 0;
-    for (; i < sects_of_block; i++) {
-        verify_sect(block_buf + i*DEFAULT_SECTOR_SIZE);
 
-        if (!(sect % (512*1024*1024/DEFAULT_SECTOR_SIZE))) // logging per 512MB
-        {
-            printf("Verifying sector %llx of %llx\n", sect, total_sects);
+    fill_block(expect, blk);
+    if (memcmp(buf, expect, block_size)) {
+        for (; i < sects_of_block; i++) {
+            verify_sect(buf + i*DEFAULT_SECTOR_SIZE, sect, &iter);
+            sect++;
         }
-        sect++;
     }
+    log_block("Verifying", blk);
 }
 
 static int getsize(int fd, struct fd_state *s)
@@ -223,6 +602,7 @@ static int getsize(int fd, struct fd_state *s)
         return -EINVAL;
     }
 
+    s->block_dev = S_ISBLK(stat.st_mode);
     if (S_ISBLK(stat.st_mode)) {
         /*Accessing block device directly*/
         s->size = 0;
@@ -274,84 +654,1077 @@ bool check_file_size(int fd)
     return true;
 }
 
-inline double get_op_elapsed(const struct timeval *start)
+/* Push written data out of dom0 and drop the cached pages of the device,
+ * so a following verify reads the data back from the array.
+ */
+void invalidate_cache(int fd)
+{
+    struct stat stat;
+
+    if (fsync(fd) != 0)
+        fprintf(stderr, "fsync failed, errno %d\n", errno);
+    if (fstat(fd, &stat) == 0 && S_ISBLK(stat.st_mode)) {
+        if (ioctl(fd, BLKFLSBUF, 0) != 0)
+            fprintf(stderr, "BLKFLSBUF failed, errno %d\n", errno);
+    }
+    posix_fadvise(fd, 0, 0, POSIX_FADV_DONTNEED);
+}
+
+/* Discard block blk, with BLKDISCARD on a block device, or by punching a
+ * hole in a file.
+ */
+int discard_block(int fd, unsigned long long blk)
+{
+    uint64_t range[2];
+
+    range[0] = blk * block_size;
+    range[1] = block_size;
+    if (state.block_dev)
+        return ioctl(fd, BLKDISCARD, range);
+    return fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, range[0], range[1]);
+}
+
+static inline unsigned long long now_ns(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+static inline unsigned int lat_bucket(unsigned long long ns)
+{
+    unsigned int shift;
+
+    if (ns < 2 * LAT_SUB)
+        return ns;
+    shift = 63 - __builtin_clzll(ns) - LAT_SUB_BITS;
+    return (shift + 1) * LAT_SUB + (ns >> shift) - LAT_SUB;
+}
+
+static inline unsigned long long lat_bucket_low(unsigned int b)
+{
+    if (b < 2 * LAT_SUB)
+        return b;
+    return (unsigned long long)(LAT_SUB + b % LAT_SUB) << (b / LAT_SUB - 1);
+}
+
+static inline unsigned long long lat_bucket_high(unsigned int b)
+{
+    if (b < 2 * LAT_SUB)
+        return b;
+    return lat_bucket_low(b) + (1ULL << (b / LAT_SUB - 1)) - 1;
+}
+
+static inline void lat_record(struct histogram *h, unsigned long long ns)
+{
+    if (h->count == 0 || ns < h->min)
+        h->min = ns;
+    if (ns > h->max)
+        h->max = ns;
+    h->count++;
+    h->buckets[lat_bucket(ns)]++;
+}
+
+void lat_merge(struct histogram *h, const struct histogram *from)
+{
+    unsigned int b;
+
+    if (from->count == 0)
+        return;
+    if (h->count == 0 || from->min < h->min)
+        h->min = from->min;
+    if (from->max > h->max)
+        h->max = from->max;
+    h->count += from->count;
+    for (b = 0; b < LAT_BUCKETS; b++)
+        h->buckets[b] += from->buckets[b];
+}
+
+/* Highest latency of the fraction q of the IOs, within its bucket */
+unsigned long long lat_percentile(const struct histogram *h, double q)
+{
+    unsigned long long rank = q * h->count, seen = 0;
+    unsigned int b;
+
+    if (rank < q * h->count || rank == 0)
+        rank++;
+    for (b = 0; b < LAT_BUCKETS; b++) {
+        seen += h->buckets[b];
+        if (seen >= rank)
+            return lat_bucket_high(b) < h->max ? lat_bucket_high(b) : h->max;
+    }
+    return h->max;
+}
+
+static inline void refill_bucket(struct bucket *b, unsigned long long ns)
+{
+    b->tokens += b->rate * ns / 1e9;
+    if (b->tokens > b->burst)
+        b->tokens = b->burst;
+}
+
+/* ns until the bucket holds cost tokens */
+static inline unsigned long long bucket_wait(const struct bucket *b, double cost)
+{
+    if (b->rate <= 0 || b->tokens >= cost)
+        return 0;
+    return (cost - b->tokens) / b->rate * 1e9 + 1;
+}
+
+/* Take the tokens of one block IO from the rate limits shared by all the
+ * workers. Return 0 when taken, or else the ns to wait for them, in which
+ * case none is taken.
+ */
+unsigned long long throttle_take(void)
+{
+    unsigned long long now, wait, ios_wait;
+
+    if (rate_mbps <= 0 && rate_iops <= 0)
+        return 0;
+    pthread_mutex_lock(&throttle_lock);
+    now = now_ns();
+    if (throttle_ns) {
+        refill_bucket(&bytes_bucket, now - throttle_ns);
+        refill_bucket(&ios_bucket, now - throttle_ns);
+    }
+    throttle_ns = now;
+    wait = bucket_wait(&bytes_bucket, block_size);
+    ios_wait = bucket_wait(&ios_bucket, 1);
+    if (ios_wait > wait)
+        wait = ios_wait;
+    if (wait == 0) {
+        bytes_bucket.tokens -= block_size;
+        ios_bucket.tokens -= 1;
+    }
+    pthread_mutex_unlock(&throttle_lock);
+    return wait;
+}
+
+static inline void sleep_ns(unsigned long long ns)
+{
+    struct timespec ts;
+
+    ts.tv_sec = ns / 1000000000;
+    ts.tv_nsec = ns % 1000000000;
+    while (nanosleep(&ts, &ts) != 0 && errno == EINTR)
+        ;
+}
+
+/* Wait until the tokens of one block IO are taken */
+static inline void throttle(void)
+{
+    unsigned long long wait;
+
+    while ((wait = throttle_take()) != 0)
+        sleep_ns(wait);
+}
+
+static inline double get_op_elapsed(const struct timeval *start)
 {
     struct timeval current_time;
     gettimeofday(&current_time, NULL);
     return (current_time.tv_sec - start->tv_sec) + (current_time.tv_usec - start->tv_usec) / 1000000.0;
 }
 
-int op_testpattern(const char *file, bool op_write)
+/* Mix the bits of x, the round function of the Feistel network */
+static inline unsigned long long mix64(unsigned long long x)
 {
-    int fd = -1;
-    mode_t mode = O_LARGEFILE;
-    unsigned long long pos, len, i, op_blocks;
-    double op_elapsed;
-    struct timeval start_time;
-    
-    mode |= op_write ? O_RDWR : O_RDONLY;
-    fd = open(file, mode);
-    if (fd == -1) {
-        fprintf(stderr, "Unable to open %s, errno %d\n", file, errno);
-        return 1;
+    /* splitmix64 finalizer */
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL;
+    return x ^ (x >> 31);
+}
+
+/* A balanced Feistel network over 2 * half_bits bits, a permutation of
+ * [0, 4^half_bits) which only depends on the seed.
+ */
+static inline unsigned long long feistel(unsigned long long x)
+{
+    unsigned long long mask = (1ULL << half_bits) - 1;
+    unsigned long long l = x >> half_bits, r = x & mask, t;
+    unsigned int i = 0;
+    for (; i < FEISTEL_ROUNDS; i++) {
+        t = r;
+        r = l ^ (mix64(r ^ mix64(seed + i)) & mask);
+        l = t;
     }
-    
-    if (!check_file_size(fd)) {
-        close(fd);
-        return 1;
+    return (l << half_bits) | r;
+}
+
+/* First block of stratum i of the sample */
+static inline unsigned long long stratum_start(unsigned long long i)
+{
+    return (unsigned __int128)i * max_blocks / seq_blocks;
+}
+
+/* Block i of the sequence: the sampled block of stratum i, which is at an
+ * offset in the stratum only depending on iter_start.
+ */
+static inline unsigned long long sample_block(unsigned long long i)
+{
+    unsigned long long start = stratum_start(i);
+
+    if (seq_blocks == max_blocks)
+        return i;
+    return start + mix64(mix64(iter_start) ^ i) % (stratum_start(i + 1) - start);
+}
+
+/* Block at position p of the order. The random order walks the Feistel
+ * cycle until it is back in [0, seq_blocks), which keeps it a permutation
+ * of the sequence. As 4^half_bits < 4 * seq_blocks, a few steps are enough.
+ */
+static inline unsigned long long order_block(unsigned long long p)
+{
+    if (random_order) {
+        do {
+            p = feistel(p);
+        } while (p >= seq_blocks);
     }
-    
-    gettimeofday(&start_time, NULL);
+    return sample_block(p);
+}
 
-    for(i = 0; i < max_blocks; i++) {
-        pos = i * block_size;
-        if (lseek(fd, pos, SEEK_SET) == (off_t)-1) {
+/* Number of blocks in the stripe of worker w */
+static inline unsigned long long stripe_blocks(const struct worker *w)
+{
+    return (op_count - w->id + threads - 1) / threads;
+}
+
+/* Position of the j-th block of the stripe in the order */
+static inline unsigned long long stripe_pos(const struct worker *w,
+                                            unsigned long long j)
+{
+    return w->id + j * threads;
+}
+
+static inline unsigned long long stripe_block(const struct worker *w,
+                                              unsigned long long j)
+{
+    return order_block(stripe_pos(w, j));
+}
+
+/* In the mixed op, choose if the next IO of worker w reads back one of the
+ * blocks [0, written) of its stripe, which are written and so verifiable,
+ * and set j to it.
+ */
+static inline bool mixed_read(struct worker *w, unsigned long long written,
+                              unsigned long long *j)
+{
+    unsigned long long r;
+
+    if (op != OP_MIXED || written == 0)
+        return false;
+    r = mix64(mix64(seed ^ iter_start) ^ mix64(w->id) ^ w->rng++);
+    if (r % 100 >= read_percent)
+        return false;
+    *j = mix64(r) % written;
+    return true;
+}
+
+/* Blocks at positions [0, n) of the order are op-ed by all the stripes of
+ * workers ws
+ */
+unsigned long long done_blocks(const struct worker *ws)
+{
+    unsigned long long n = op_count, first_undone;
+    unsigned long i;
+
+    for (i = 0; i < threads; i++) {
+        first_undone = stripe_pos(&ws[i], ws[i].done);
+        if (first_undone < n)
+            n = first_undone;
+    }
+    return n;
+}
+
+static inline bool should_stop(const struct worker *w)
+{
+    /* A verifier in writeverify verifies all the writer wrote in time */
+    return failed || (stop && !w->gate);
+}
+
+/* Let the verifier of the stripe read back the blocks written so far. */
+void publish(struct worker *w, bool finished)
+{
+    unsigned long long from, to, j;
+
+    if (op != OP_WRITEVERIFY || !w->op_write)
+        return;
+    if (!finished && w->done - w->published < window)
+        return;
+
+    if (!direct_io && w->done > w->published) {
+        /* Make the verifier read the window back from the array */
+        fdatasync(w->fd);
+        if (random_order) {
+            for (j = w->published; j < w->done; j++)
+                posix_fadvise(w->fd, stripe_block(w, j) * block_size,
+                              block_size, POSIX_FADV_DONTNEED);
+        } else {
+            from = stripe_block(w, w->published) * block_size;
+            to = (stripe_block(w, w->done - 1) + 1) * block_size;
+            posix_fadvise(w->fd, from, to - from, POSIX_FADV_DONTNEED);
+        }
+    }
+
+    pthread_mutex_lock(&w->lock);
+    w->published = w->done;
+    w->finished = w->finished || finished;
+    pthread_cond_broadcast(&w->cond);
+    pthread_mutex_unlock(&w->lock);
+}
+
+/* Check if block j of the stripe of verifier w has been written, and
+ * with wait set, wait until it is written or will never be.
+ */
+int gate_wait(const struct worker *w, unsigned long long j, bool wait)
+{
+    struct worker *g = w->gate;
+    int ret;
+
+    pthread_mutex_lock(&g->lock);
+    for (;;) {
+        if (j < g->published) {
+            ret = GATE_OPEN;
+            break;
+        }
+        if (g->finished || failed) {
+            ret = GATE_CLOSED;
+            break;
+        }
+        if (!wait) {
+            ret = GATE_PENDING;
+            break;
+        }
+        pthread_cond_wait(&g->cond, &g->lock);
+    }
+    pthread_mutex_unlock(&g->lock);
+    return ret;
+}
+
+/* Synchronous engine: one lseek() + atomicio() per block */
+int op_sync(struct worker *w)
+{
+    unsigned long long pos, len, j, blk, count = stripe_blocks(w), t0, rj;
+    struct histogram *lat;
+    bool read_back;
+
+    for (j = w->done; j < count && !should_stop(w); ) {
+        if (w->gate && gate_wait(w, j, true) != GATE_OPEN)
+            break;
+        throttle();
+        read_back = mixed_read(w, j, &rj);
+        blk = stripe_block(w, read_back ? rj : j);
+        pos = blk * block_size;
+        if (lseek(w->fd, pos, SEEK_SET) == (off_t)-1) {
             fprintf(stderr, "Unable to seek to offset %llx\n", pos);
-            close(fd);
-            return 1;
+            return EXIT_IO_ERROR;
         }
 
-        if (op_write) {
-            update_block();
-            len = atomicio(vwrite, fd, block_buf, block_size);
-            if (len < block_size) {
-                fprintf(stderr, "Write block %llx failed\n", i);
-                close(fd);
+        lat = read_back ? &w->read_lat : &w->lat;
+        if (op == OP_DISCARD) {
+            t0 = now_ns();
+            len = discard_block(w->fd, blk);
+            lat_record(lat, now_ns() - t0);
+            if (len != 0) {
+                fprintf(stderr, "Discard block %llx failed, errno %d\n", blk, errno);
                 return 1;
             }
+        } else if (w->op_write && !read_back) {
+            update_block(w->buf, blk);
+            t0 = now_ns();
+            len = atomicio(vwrite, w->fd, w->buf, block_size);
+            lat_record(lat, now_ns() - t0);
+            if (len < block_size) {
+                fprintf(stderr, "Write block %llx failed\n", blk);
+                return EXIT_IO_ERROR;
+            }
         } else {
-            len = atomicio(read, fd, block_buf, block_size);
+            t0 = now_ns();
+            len = atomicio(read, w->fd, w->buf, block_size);
+            lat_record(lat, now_ns() - t0);
             if (len < block_size) {
-                fprintf(stderr, "Read block %llx failed\n", i);
-                close(fd);
+                fprintf(stderr, "Read block %llx failed\n", blk);
+                return EXIT_IO_ERROR;
+            }
+            verify_block(w->buf, w->expect, blk);
+        }
+
+        if (read_back) {
+            w->reads++;
+        } else {
+            w->done = ++j;
+            w->ios++;
+            publish(w, false);
+        }
+        if (max_time > 0 && get_op_elapsed(&start_time) >= max_time)
+            stop = true;
+    }
+
+    return 0;
+}
+
+/* Asynchronous engine: keep up to queue_depth block IOs in flight. Blocks
+ * are submitted in stripe order, and w->done follows the first block still
+ * in flight, so the stripe is always op-ed up to w->done. The read backs of
+ * the mixed op are only of blocks before w->done.
+ */
+int op_aio(struct worker *w)
+{
+    aio_context_t ctx = 0;
+    struct iocb *cbs = NULL, **cbp = NULL;
+    struct io_event *events = NULL;
+    struct timespec timeout, *ptimeout;
+    unsigned long long *slot_blk = NULL, *slot_pos = NULL, *free_slots = NULL;
+    unsigned long long *slot_start = NULL, now, wait, rj;
+    unsigned long long next = w->done, nfree = queue_depth, slot, first;
+    unsigned long long count = stripe_blocks(w);
+    char *buf;
+    bool *slot_read = NULL, op_write;
+    long inflight = 0, nsub, i;
+    int n, ret = 1;
+
+    cbs = calloc(queue_depth, sizeof(*cbs));
+    cbp = calloc(queue_depth, sizeof(*cbp));
+    events = calloc(queue_depth, sizeof(*events));
+    slot_blk = calloc(queue_depth, sizeof(*slot_blk));
+    slot_pos = calloc(queue_depth, sizeof(*slot_pos));
+    slot_start = calloc(queue_depth, sizeof(*slot_start));
+    free_slots = calloc(queue_depth, sizeof(*free_slots));
+    slot_read = calloc(queue_depth, sizeof(*slot_read));
+    if (!cbs || !cbp || !events || !slot_blk || !slot_pos || !slot_start || !free_slots ||
+        !slot_read) {
+        fprintf(stderr, "Malloc AIO control blocks failed\n");
+        goto out;
+    }
+    for (slot = 0; slot < queue_depth; slot++) {
+        free_slots[slot] = slot;
+        slot_pos[slot] = ULLONG_MAX;
+    }
+
+    if (kaio_setup(queue_depth, &ctx) != 0) {
+        fprintf(stderr, "Unable to set up AIO context, errno %d\n", errno);
+        ctx = 0;
+        goto out;
+    }
+
+    for (;;) {
+        nsub = 0;
+        wait = 0;
+        while (!should_stop(w) && nfree > 0 && next < count) {
+            if (w->gate) {
+                n = gate_wait(w, next, inflight + nsub == 0);
+                if (n == GATE_CLOSED)
+                    count = next;
+                if (n != GATE_OPEN)
+                    break;
+            }
+            /* out of tokens, reap the IOs in flight while they come in */
+            wait = throttle_take();
+            if (wait && inflight + nsub == 0) {
+                sleep_ns(wait);
+                continue;
+            }
+            if (wait)
+                break;
+            slot = free_slots[--nfree];
+            buf = w->buf + slot * block_size;
+            slot_read[slot] = mixed_read(w, w->done, &rj);
+            if (slot_read[slot]) {
+                slot_blk[slot] = stripe_block(w, rj);
+            } else {
+                slot_pos[slot] = next;
+                slot_blk[slot] = stripe_block(w, next);
+                next++;
+            }
+            op_write = w->op_write && !slot_read[slot];
+            if (op_write)
+                update_block(buf, slot_blk[slot]);
+            kaio_prep(&cbs[slot], w->fd, op_write, buf, block_size,
+                      slot_blk[slot] * block_size, slot);
+            cbp[nsub++] = &cbs[slot];
+        }
+        now = now_ns();
+        for (i = 0; i < nsub; i++)
+            slot_start[cbp[i]->aio_data] = now;
+        for (i = 0; i < nsub; ) {
+            n = kaio_submit(ctx, nsub - i, cbp + i);
+            if (n < 0) {
+                if (errno == EINTR || errno == EAGAIN)
+                    continue;
+                fprintf(stderr, "IO submit failure: [%d]\n", errno);
+                ret = EXIT_IO_ERROR;
+                goto out;
+            }
+            i += n;
+            inflight += n;
+        }
+
+        if (inflight == 0)
+            break;
+
+        ptimeout = NULL;
+        if (wait) {
+            timeout.tv_sec = wait / 1000000000;
+            timeout.tv_nsec = wait % 1000000000;
+            ptimeout = &timeout;
+        }
+        n = kaio_getevents(ctx, 1, inflight, events, ptimeout);
+        if (n < 0) {
+            if (errno == EINTR)
+                continue;
+            fprintf(stderr, "IO getevents failure: [%d]\n", errno);
+            ret = EXIT_IO_ERROR;
+            goto out;
+        }
+        now = now_ns();
+        for (i = 0; i < n; i++) {
+            slot = events[i].data;
+            inflight--;
+            op_write = w->op_write && !slot_read[slot];
+            lat_record(slot_read[slot] ? &w->read_lat : &w->lat, now - slot_start[slot]);
+            if (events[i].res != (long long)block_size) {
+                if (events[i].res < 0)
+                    fprintf(stderr, "IO failure: [%lld]\n", -(long long)events[i].res);
+                fprintf(stderr, "%s block %llx failed\n",
+                        op_write ? "Write" : "Read", slot_blk[slot]);
+                ret = EXIT_IO_ERROR;
+                goto out;
+            }
+            if (!op_write)
+                verify_block(w->buf + slot * block_size, w->expect, slot_blk[slot]);
+            if (slot_read[slot])
+                w->reads++;
+            else
+                w->ios++;
+            slot_pos[slot] = ULLONG_MAX;
+            free_slots[nfree++] = slot;
+        }
+
+        first = next;
+        for (slot = 0; slot < queue_depth; slot++) {
+            if (slot_pos[slot] < first)
+                first = slot_pos[slot];
+        }
+        w->done = first;
+        publish(w, false);
+
+        if (max_time > 0 && get_op_elapsed(&start_time) >= max_time)
+            stop = true;
+    }
+
+    w->done = next;
+    ret = 0;
+
+out:
+    /* io_destroy() waits for the IOs still in flight */
+    if (ctx)
+        kaio_destroy(ctx);
+    free(slot_read);
+    free(free_slots);
+    free(slot_pos);
+    free(slot_start);
+    free(slot_blk);
+    free(events);
+    free(cbp);
+    free(cbs);
+    return ret;
+}
+
+/* Block IOs completed by all the workers of the op */
+unsigned long long op_ios(bool op_write)
+{
+    unsigned long long ios = 0;
+    unsigned long i;
+
+    for (i = 0; i < nworkers; i++) {
+        if (workers[i].op_write == op_write)
+            ios += workers[i].ios;
+    }
+    return ios + resume_blocks;
+}
+
+/* Blocks read back by all the workers of the mixed op */
+unsigned long long read_ios(void)
+{
+    unsigned long long ios = 0;
+    unsigned long i;
+
+    for (i = 0; i < nworkers; i++)
+        ios += workers[i].reads;
+    return ios;
+}
+
+void print_progress(const char *name, double elapsed, double interval,
+                    unsigned long long ios, unsigned long long last_ios,
+                    unsigned long long errors)
+{
+    printf("{\"type\": \"progress\", \"op\": \"%s\", \"elapsed\": %.3f, "
+           "\"bytes\": %llu, \"mbps\": %.3f, \"iops\": %.1f, \"errors\": %llu}\n",
+           name, elapsed, ios * block_size,
+           (ios - last_ios) * block_size / interval / (1024 * 1024),
+           (ios - last_ios) / interval, errors);
+}
+
+/* Name of the op of the writers in the records */
+static inline const char *write_name(void)
+{
+    return op == OP_DISCARD ? "discard" : "write";
+}
+
+/* Print how much of the device the sampled blocks [0, blocks) cover, if
+ * they are short of all its blocks, by sampling or by <time> cutting the op
+ * short.
+ */
+void print_coverage(bool op_write, unsigned long long blocks)
+{
+    if (seq_blocks == max_blocks && blocks == seq_blocks)
+        return;
+
+    unsigned long long stratum = (max_blocks + seq_blocks - 1) / seq_blocks;
+
+    printf("{\"type\": \"coverage\", \"op\": \"%s\", \"blocks\": %llu, "
+           "\"sample_blocks\": %llu, \"total_blocks\": %llu, \"fraction\": %.9f, ",
+           op_write ? write_name() : "verify", blocks, seq_blocks, max_blocks,
+           (double)blocks / max_blocks);
+    /* Blocks of a fault spread over the device are all missed by chance
+     * (1 - f)^blocks, and every run of 2 strata holds a sampled block.
+     */
+    printf("\"detect_fraction_95\": %.9f, ",
+           blocks ? 1 - pow(0.05, 1.0 / blocks) : 1.0);
+    if (blocks == seq_blocks)
+        printf("\"max_gap_blocks\": %llu}\n", 2 * stratum - 2);
+    else
+        printf("\"max_gap_blocks\": null}\n");
+}
+
+/* Print the latency of the block IOs of all the workers of the op, or of
+ * the read backs of the mixed op with read_back set.
+ */
+void print_latency(bool op_write, bool read_back)
+{
+    struct histogram h;
+    unsigned long i;
+    unsigned int b;
+    bool first = true;
+
+    memset(&h, 0, sizeof(h));
+    for (i = 0; i < nworkers; i++) {
+        if (read_back)
+            lat_merge(&h, &workers[i].read_lat);
+        else if (workers[i].op_write == op_write)
+            lat_merge(&h, &workers[i].lat);
+    }
+
+    printf("{\"type\": \"latency\", \"op\": \"%s\", \"count\": %llu, \"min_us\": %.3f, "
+           "\"p50_us\": %.3f, \"p90_us\": %.3f, \"p99_us\": %.3f, \"p999_us\": %.3f, "
+           "\"max_us\": %.3f, \"buckets\": [",
+           read_back ? "read" : op_write ? write_name() : "verify", h.count, h.min / 1000.0,
+           lat_percentile(&h, 0.5) / 1000.0, lat_percentile(&h, 0.9) / 1000.0,
+           lat_percentile(&h, 0.99) / 1000.0, lat_percentile(&h, 0.999) / 1000.0,
+           h.max / 1000.0);
+    for (b = 0; b < LAT_BUCKETS; b++) {
+        if (!h.buckets[b])
+            continue;
+        printf("%s[%.3f, %.3f, %llu]", first ? "" : ", ", lat_bucket_low(b) / 1000.0,
+               lat_bucket_high(b) / 1000.0, h.buckets[b]);
+        first = false;
+    }
+    printf("]}\n");
+}
+
+static const char *op_name(int op)
+{
+    return op == OP_WRITE ? "write" : op == OP_VERIFY ? "verify" :
+           op == OP_WRITEVERIFY ? "writeverify" : op == OP_MIXED ? "mixed" : "discard";
+}
+
+/* Blocks [0, n) of the order are op-ed, and are all verified in writeverify */
+static inline unsigned long long resumable_blocks(void)
+{
+    return done_blocks(op == OP_WRITEVERIFY ? workers + threads : workers);
+}
+
+/* Save the progress of the op, through a rename so that the checkpoint is
+ * either the previous or the new one after a crash.
+ */
+int save_checkpoint(void)
+{
+    char tmp[PATH_MAX];
+    FILE *f;
+    int ret;
+
+    snprintf(tmp, sizeof(tmp), "%s.tmp", checkpoint_file);
+    f = fopen(tmp, "w");
+    if (!f) {
+        fprintf(stderr, "Unable to open checkpoint %s, errno %d\n", tmp, errno);
+        return 1;
+    }
+    fprintf(f, "op %s\n", op_name(op));
+    fprintf(f, "device %s\n", device);
+    fprintf(f, "block %llu\n", sects_of_block);
+    fprintf(f, "mass %llu\n", max_blocks);
+    fprintf(f, "iter %llu\n", iter_start);
+    fprintf(f, "random %d\n", random_order);
+    fprintf(f, "seed %llu\n", seed);
+    fprintf(f, "fraction %.17g\n", sample_fraction);
+    fprintf(f, "count %llu\n", op_count);
+    fprintf(f, "done %llu\n", resumable_blocks());
+    fprintf(f, "errors %llu\n", sect_errors);
+    fprintf(f, "elapsed %f\n", get_op_elapsed(&start_time));
+    ret = fflush(f) || fsync(fileno(f));
+    ret = fclose(f) || ret;
+    if (ret || rename(tmp, checkpoint_file)) {
+        fprintf(stderr, "Unable to save checkpoint %s, errno %d\n", checkpoint_file, errno);
+        return 1;
+    }
+    return 0;
+}
+
+/* Load the progress of the op from the checkpoint, after checking it is
+ * the same op.
+ */
+int load_checkpoint(void)
+{
+    char key[32], value[PATH_MAX];
+    char number[32];
+    bool match = true;
+    FILE *f;
+
+    f = fopen(checkpoint_file, "r");
+    if (!f) {
+        fprintf(stderr, "Unable to open checkpoint %s, errno %d\n", checkpoint_file, errno);
+        return 1;
+    }
+    while (fscanf(f, "%31s %4095[^\n]", key, value) == 2) {
+        if (!strcmp(key, "op")) {
+            match = match && !strcmp(value, op_name(op));
+        } else if (!strcmp(key, "device")) {
+            match = match && !strcmp(value, device);
+        } else if (!strcmp(key, "block")) {
+            match = match && strtoull(value, NULL, 10) == sects_of_block;
+        } else if (!strcmp(key, "mass")) {
+            match = match && strtoull(value, NULL, 10) == max_blocks;
+        } else if (!strcmp(key, "iter")) {
+            match = match && strtoull(value, NULL, 10) == iter_start;
+        } else if (!strcmp(key, "random")) {
+            match = match && atoi(value) == random_order;
+        } else if (!strcmp(key, "seed")) {
+            match = match && strtoull(value, NULL, 10) == seed;
+        } else if (!strcmp(key, "fraction")) {
+            snprintf(number, sizeof(number), "%.17g", sample_fraction);
+            match = match && !strcmp(value, number);
+        } else if (!strcmp(key, "count")) {
+            match = match && strtoull(value, NULL, 10) == op_count;
+        } else if (!strcmp(key, "done")) {
+            resume_blocks = strtoull(value, NULL, 10);
+        } else if (!strcmp(key, "errors")) {
+            sect_errors = strtoull(value, NULL, 10);
+        } else if (!strcmp(key, "elapsed")) {
+            resume_elapsed = strtod(value, NULL);
+        }
+    }
+    fclose(f);
+
+    if (!match || resume_blocks > op_count) {
+        fprintf(stderr, "Checkpoint %s is not of this op\n", checkpoint_file);
+        return 1;
+    }
+    return 0;
+}
+
+/* Print the progress of the ops every progress_interval, and save it to
+ * the checkpoint, until the workers are done.
+ */
+void *progress_run(void *arg)
+{
+    unsigned long long write_ios = resume_blocks, verify_ios = resume_blocks, reads = 0, ios;
+    double elapsed, last_elapsed = resume_elapsed;
+    double interval = progress_interval > 0 ? progress_interval : CHECKPOINT_INTERVAL;
+    struct timespec deadline;
+    unsigned long long ns;
+    int ret;
+
+    (void)arg;
+    pthread_mutex_lock(&progress_lock);
+    while (!progress_done) {
+        clock_gettime(CLOCK_REALTIME, &deadline);
+        ns = deadline.tv_nsec + (unsigned long long)(interval * 1e9);
+        deadline.tv_sec += ns / 1000000000;
+        deadline.tv_nsec = ns % 1000000000;
+        do {
+            ret = pthread_cond_timedwait(&progress_cond, &progress_lock, &deadline);
+        } while (!progress_done && ret != ETIMEDOUT);
+        if (progress_done)
+            break;
+
+        if (checkpoint_file)
+            save_checkpoint();
+        if (progress_interval <= 0)
+            continue;
+        elapsed = get_op_elapsed(&start_time);
+        if (op != OP_VERIFY) {
+            ios = op_ios(true);
+            print_progress(write_name(), elapsed, elapsed - last_elapsed, ios, write_ios, 0);
+            write_ios = ios;
+        }
+        if (op == OP_VERIFY || op == OP_WRITEVERIFY) {
+            ios = op_ios(false);
+            print_progress("verify", elapsed, elapsed - last_elapsed, ios, verify_ios, sect_errors);
+            verify_ios = ios;
+        }
+        if (op == OP_MIXED) {
+            ios = read_ios();
+            print_progress("read", elapsed, elapsed - last_elapsed, ios, reads, sect_errors);
+            reads = ios;
+        }
+        fflush(stdout);
+        last_elapsed = elapsed;
+    }
+    pthread_mutex_unlock(&progress_lock);
+    return NULL;
+}
+
+void *worker_run(void *arg)
+{
+    struct worker *w = arg;
+
+    if (queue_depth > 1)
+        w->ret = op_aio(w);
+    else
+        w->ret = op_sync(w);
+    if (w->ret)
+        failed = true;  // a failed stripe fails the whole op
+    w->elapsed = get_op_elapsed(&start_time);
+    publish(w, true);
+    return NULL;
+}
+
+int init_worker(struct worker *w, unsigned long id, unsigned long dev, bool op_write)
+{
+    mode_t mode = O_LARGEFILE;
+    const char *file = devices[dev];
+
+    memset(w, 0, sizeof(*w));
+    w->id = id;
+    w->dev = dev;
+    w->op_write = op_write;
+    w->fd = -1;
+    pthread_mutex_init(&w->lock, NULL);
+    pthread_cond_init(&w->cond, NULL);
+
+    mode |= op_write ? O_RDWR : O_RDONLY;
+    if (direct_io)
+        mode |= O_DIRECT;
+    w->fd = open(file, mode);
+    if (w->fd == -1) {
+        fprintf(stderr, "Unable to open %s, errno %d\n", file, errno);
+        return 1;
+    }
+
+    /* O_DIRECT needs buffers aligned to the logical block size */
+    if (posix_memalign((void **)&w->buf, BUF_ALIGN, block_size * queue_depth)) {
+        w->buf = NULL;
+        fprintf(stderr, "Malloc block buffer failed\n");
+        return 1;
+    }
+    if ((!op_write || op == OP_MIXED) &&
+        posix_memalign((void **)&w->expect, BUF_ALIGN, block_size)) {
+        w->expect = NULL;
+        fprintf(stderr, "Malloc expected block buffer failed\n");
+        return 1;
+    }
+    return 0;
+}
+
+void free_workers()
+{
+    unsigned long i;
+
+    if (!workers)
+        return;
+    for (i = 0; i < nworkers; i++) {
+        if (workers[i].fd != -1)
+            close(workers[i].fd);
+        free(workers[i].buf);
+        free(workers[i].expect);
+    }
+    free(workers);
+    workers = NULL;
+}
+
+/* Print the block IOs done through each path */
+void print_devices(void)
+{
+    unsigned long long write_ios, verify_ios;
+    unsigned long i, d;
+
+    for (d = 0; d < ndevices; d++) {
+        write_ios = verify_ios = 0;
+        for (i = 0; i < nworkers; i++) {
+            if (workers[i].dev != d)
+                continue;
+            if (workers[i].op_write)
+                write_ios += workers[i].ios;
+            else
+                verify_ios += workers[i].ios;
+            verify_ios += workers[i].reads;
+        }
+        printf("{\"type\": \"device\", \"device\": \"%s\", \"write_ios\": %llu, "
+               "\"verify_ios\": %llu}\n", devices[d], write_ios, verify_ios);
+    }
+}
+
+int op_testpattern(void)
+{
+    int ret = 0;
+    unsigned long i, started = 0;
+    unsigned long long op_blocks = 0, verify_blocks = 0;
+    double op_elapsed = 0, verify_elapsed = 0;
+    bool op_write = op != OP_VERIFY, reporting;
+    pthread_t progress_thread;
+    long long usec;
+
+    workers = calloc(nworkers, sizeof(*workers));
+    if (!workers) {
+        fprintf(stderr, "Malloc workers failed\n");
+        return 1;
+    }
+    for (i = 0; i < nworkers; i++)
+        workers[i].fd = -1;
+    for (i = 0; i < nworkers; i++) {
+        /* in writeverify the verifiers follow the writers, on the next path */
+        if (init_worker(&workers[i], i % threads, (i % threads + i / threads) % ndevices,
+                        i < threads && op_write)) {
+            free_workers();
+            return 1;
+        }
+        if (i >= threads)
+            workers[i].gate = &workers[i - threads];
+    }
+    if (resume) {
+        if (load_checkpoint()) {
+            free_workers();
+            return 1;
+        }
+        /* start each stripe at its first block from resume_blocks on */
+        for (i = 0; i < nworkers; i++) {
+            if (resume_blocks > workers[i].id)
+                workers[i].done = (resume_blocks - workers[i].id + threads - 1) / threads;
+            workers[i].published = workers[i].done;
+        }
+    }
+    
+    /* workers [0, ndevices) cover all the paths, unless there are fewer blocks */
+    for (i = 0; i < ndevices && i < threads; i++) {
+        if (!check_file_size(workers[i].fd)) {
+            free_workers();
+            return 1;
+        }
+        if (direct_io) {
+            if (block_size % state.sector_size) {
+                fprintf(stderr, "Block size %llu is not a multiple of the sector size %lu\n",
+                        block_size, state.sector_size);
+                free_workers();
                 return 1;
             }
-            verify_block();
+            if (op == OP_VERIFY)
+                invalidate_cache(workers[i].fd);
         }
+    }
+    
+    gettimeofday(&start_time, NULL);
+    /* a resumed op goes on with the time it took before */
+    usec = resume_elapsed * 1000000;
+    start_time.tv_sec -= usec / 1000000;
+    start_time.tv_usec -= usec % 1000000;
+    if (start_time.tv_usec < 0) {
+        start_time.tv_usec += 1000000;
+        start_time.tv_sec--;
+    }
+
+    reporting = progress_interval > 0 || checkpoint_file;
+    if (reporting && pthread_create(&progress_thread, NULL, progress_run, NULL)) {
+        fprintf(stderr, "Unable to create progress reporter\n");
+        reporting = false;
+    }
 
-        op_blocks = i + 1;
-        op_elapsed = get_op_elapsed(&start_time);
-        if (max_time > 0 && op_elapsed >= max_time)
+    for (i = 0; i < nworkers; i++) {
+        if (pthread_create(&workers[i].thread, NULL, worker_run, &workers[i])) {
+            fprintf(stderr, "Unable to create worker %lu\n", i);
+            failed = true;
+            ret = 1;
             break;
+        }
+        started++;
+    }
+    /* wake up any verifier waiting for a writer which was not started */
+    for (i = started; i < threads; i++)
+        publish(&workers[i], true);
+    /* the op can only be resumed if every worker which failed had an IO error */
+    for (i = 0; i < started; i++) {
+        pthread_join(workers[i].thread, NULL);
+        if (workers[i].ret && ret != 1)
+            ret = workers[i].ret;
+    }
+    if (reporting) {
+        pthread_mutex_lock(&progress_lock);
+        progress_done = true;
+        pthread_cond_signal(&progress_cond);
+        pthread_mutex_unlock(&progress_lock);
+        pthread_join(progress_thread, NULL);
+    }
+    if (checkpoint_file)
+        save_checkpoint();
+    if (ret) {
+        free_workers();
+        return ret;
+    }
+    op_blocks = done_blocks(workers);
+    for (i = 0; i < threads; i++) {
+        if (workers[i].elapsed > op_elapsed)
+            op_elapsed = workers[i].elapsed;
+    }
+
+    if (direct_io && (op == OP_WRITE || op == OP_MIXED)) {
+        for (i = 0; i < ndevices && i < threads; i++)
+            invalidate_cache(workers[i].fd);
     }
     
-    printf("%llu %llu %f %llu\n", max_blocks, op_blocks, op_elapsed, sect_errors);
+    if (ndevices > 1)
+        print_devices();
+    if (op != OP_VERIFY)
+        print_latency(true, false);
+    if (op == OP_VERIFY || op == OP_WRITEVERIFY)
+        print_latency(false, false);
+    if (op == OP_MIXED)
+        print_latency(true, true);
+    if (op == OP_WRITEVERIFY) {
+        verify_blocks = done_blocks(workers + threads);
+        for (i = threads; i < nworkers; i++) {
+            if (workers[i].elapsed > verify_elapsed)
+                verify_elapsed = workers[i].elapsed;
+        }
+        print_coverage(false, verify_blocks);
+        printf("%llu %llu %f %llu %llu %f\n", max_blocks, op_blocks, op_elapsed,
+               sect_errors, verify_blocks, verify_elapsed);
+    } else if (op == OP_MIXED) {
+        print_coverage(true, op_blocks);
+        printf("%llu %llu %f %llu %llu\n", max_blocks, op_blocks, op_elapsed,
+               sect_errors, read_ios());
+    } else {
+        print_coverage(op != OP_VERIFY, op_blocks);
+        printf("%llu %llu %f %llu\n", max_blocks, op_blocks, op_elapsed, sect_errors);
+    }
     
-    close(fd);
+    free_workers();
     return 0;
 }
 
 
 int main(int argc, char *argv[])
 {
-    int ret;
-    
     init_params(argc, argv);
-    alloc_block_buf();
 
-    ret = op_testpattern(argv[2], !strcmp(argv[1], "write"));
-    
-    free_block_buf();
-
-    return ret;
+    return op_testpattern();
 }
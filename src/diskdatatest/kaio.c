@@ -0,0 +1,51 @@
+/*
+ * Copyright (C) Citrix Systems Inc.
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Lesser General Public License as published
+ * by the Free Software Foundation; version 2.1 only.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU Lesser General Public License for more details.
+ */
+
+#include <string.h>
+#include <unistd.h>
+#include <sys/syscall.h>
+#include "kaio.h"
+
+int kaio_setup(unsigned int nr_events, aio_context_t *ctx)
+{
+    return syscall(__NR_io_setup, nr_events, ctx);
+}
+
+int kaio_destroy(aio_context_t ctx)
+{
+    return syscall(__NR_io_destroy, ctx);
+}
+
+int kaio_submit(aio_context_t ctx, long nr, struct iocb **iocbpp)
+{
+    return syscall(__NR_io_submit, ctx, nr, iocbpp);
+}
+
+int kaio_getevents(aio_context_t ctx, long min_nr, long nr,
+                   struct io_event *events, struct timespec *timeout)
+{
+    return syscall(__NR_io_getevents, ctx, min_nr, nr, events, timeout);
+}
+
+void kaio_prep(struct iocb *cb, int fd, bool op_write, void *buf,
+               unsigned long long len, unsigned long long offset,
+               unsigned long long data)
+{
+    memset(cb, 0, sizeof(*cb));
+    cb->aio_lio_opcode = op_write ? IOCB_CMD_PWRITE : IOCB_CMD_PREAD;
+    cb->aio_fildes = fd;
+    cb->aio_buf = (unsigned long)buf;
+    cb->aio_nbytes = len;
+    cb->aio_offset = offset;
+    cb->aio_data = data;
+}
@@ -0,0 +1,35 @@
+/*
+ * Copyright (C) Citrix Systems Inc.
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Lesser General Public License as published
+ * by the Free Software Foundation; version 2.1 only.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU Lesser General Public License for more details.
+ */
+
+/*
+ * Linux native AIO, called through the raw syscalls so that diskdatatest
+ * neither needs libaio at build time nor at run time in dom0.
+ */
+#ifndef _KAIO_H
+#define _KAIO_H
+
+#include <stdbool.h>
+#include <time.h>
+#include <linux/aio_abi.h>
+
+int kaio_setup(unsigned int nr_events, aio_context_t *ctx);
+int kaio_destroy(aio_context_t ctx);
+int kaio_submit(aio_context_t ctx, long nr, struct iocb **iocbpp);
+int kaio_getevents(aio_context_t ctx, long min_nr, long nr,
+                   struct io_event *events, struct timespec *timeout);
+
+void kaio_prep(struct iocb *cb, int fd, bool op_write, void *buf,
+               unsigned long long len, unsigned long long offset,
+               unsigned long long data);
+
+#endif